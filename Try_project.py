@@ -1,13 +1,14 @@
-from distutils.command.upload import upload
-
+import math
 import pygame
+import threading
 import time
 import numpy as np
-import soundfile as sf
-import tkinter as tk
-from tkinter import filedialog
-from scipy.signal import butter, sosfilt
-from blackboard import parse_midi, generate_audio
+from blackboard import ConversionStats, GeneratedAudio, mix_stems, render_preview
+from conversion_cache import default_cache
+from conversion_worker import ConversionWorker
+from export import EXPORT_CHOICES, export_samples
+from file_listing import DirectoryCache
+from sequencer import PatternGrid, PatternPlayer, SongPlayer, render_pattern, step_samples_for
 import os
 
 pygame.init()
@@ -39,36 +40,57 @@ INITIAL_GRID_COLS = 16
 CELL_SIZE = 40
 FIXED_COL_X_RATIO = 0.1
 
-background_image = pygame.image.load("background.png")
-background_image = pygame.transform.scale(background_image, (WIDTH, HEIGHT))
-
 screen = pygame.display.set_mode((WIDTH, HEIGHT), pygame.RESIZABLE)
 pygame.display.set_caption("PixelTone - 8-bit Music Sequencer")
+
+# the background is decoded and scaled on a thread; frames use a plain fill until it is ready
+background_image = None
+
+
+def load_background():
+    global background_image
+    try:
+        image = pygame.image.load(os.path.join(os.path.dirname(os.path.abspath(__file__)), "background.png"))
+        image = pygame.transform.scale(image, (WIDTH, HEIGHT))
+    except (pygame.error, FileNotFoundError) as e:
+        print(f"No background image: {e}")
+        return
+    background_image = image
+
+
+threading.Thread(target=load_background, name="background-loader", daemon=True).start()
 font = pygame.font.Font(None, 36)
 small_font = pygame.font.Font(None, 24)
 title_font = pygame.font.Font(None, 48)
 
-is_playing = False
 bps = 2
-playbar_x = None
-playbar_interval = 1 / bps
-last_update_time = time.time()
+FPS = 60
 is_generated_audio_playing = False
 
 SLIDER_MIN_COLUMNS = 4
-SLIDER_MAX_COLUMNS = 32
+# the Col slider is logarithmic, so both short loops and song-length patterns are easy to pick
+SLIDER_MAX_COLUMNS = 4096
 slider_columns = INITIAL_GRID_COLS
+# columns on screen at once; longer patterns scroll, and only the visible ones are drawn
+VIEW_COLUMNS = 32
+grid_scroll = 0
 
 SLIDER_MIN_BPS = 1
 SLIDER_MAX_BPS = 10
 slider_bps = bps
 
-grid = [[0 for _ in range(INITIAL_GRID_COLS)] for _ in range(GRID_ROWS)]
+grid = PatternGrid(GRID_ROWS, INITIAL_GRID_COLS)
 
 FREQUENCIES = [523, 494, 466, 440, 392, 349, 330, 294, 262, 247, 220, 196, 175, 165, 147, 131]
 
 SOUND_STYLES = ["Default", "GameBoy", "NES"]
 current_sound_style = "NES"
+# (wave_ratios, noise_ratio) each style applies to a loaded song
+STYLE_MIXES = {
+    "Default": ({'square': 0.75, 'triangle': 0.3}, 0.1),
+    "GameBoy": ({'square': 0.9, 'triangle': 0.15}, 0.05),
+    "NES": ({'square': 0.6, 'triangle': 0.5}, 0.12),
+}
 style_buttons = [pygame.Rect(15, 320 + i * 50, 120, 40) for i in range(len(SOUND_STYLES))]
 
 
@@ -85,7 +107,7 @@ def safe_file_dialog(func, *args, **kwargs):
 def generate_default_square_wave(freq, duration=0.3, sample_rate=44100):
     t = np.linspace(0, duration, int(sample_rate * duration), False)
     wave = 0.5 * (1 + np.sign(np.sin(2 * np.pi * freq * t)))
-    return pygame.mixer.Sound(buffer=(wave * 32767).astype(np.int16).tobytes())
+    return wave
 
 
 def generate_gameboy_wave(freq, duration=0.3, sample_rate=44100):
@@ -93,7 +115,7 @@ def generate_gameboy_wave(freq, duration=0.3, sample_rate=44100):
     wave = 0.5 * (1 + np.sign(np.sin(2 * np.pi * freq * t)))
     envelope = np.exp(-5 * t)
     wave *= envelope
-    return pygame.mixer.Sound(buffer=(wave * 32767).astype(np.int16).tobytes())
+    return wave
 
 
 def generate_nes_triangle_wave(freq, duration=0.3, sample_rate=44100):
@@ -101,20 +123,46 @@ def generate_nes_triangle_wave(freq, duration=0.3, sample_rate=44100):
     wave = 2 * np.abs(2 * ((freq * t) % 1) - 1) - 1
     envelope = np.exp(-5 * t)
     wave *= envelope
-    return pygame.mixer.Sound(buffer=(wave * 32767).astype(np.int16).tobytes())
+    return wave
 
 
 def regenerate_sounds():
-    global SOUNDS
+    global WAVES, pattern_dirty
     if current_sound_style == "Default":
-        SOUNDS = [generate_default_square_wave(f) for f in FREQUENCIES]
+        WAVES = [generate_default_square_wave(f) for f in FREQUENCIES]
     elif current_sound_style == "GameBoy":
-        SOUNDS = [generate_gameboy_wave(f) for f in FREQUENCIES]
+        WAVES = [generate_gameboy_wave(f) for f in FREQUENCIES]
     elif current_sound_style == "NES":
-        SOUNDS = [generate_nes_triangle_wave(f) for f in FREQUENCIES]
+        WAVES = [generate_nes_triangle_wave(f) for f in FREQUENCIES]
+    pattern_dirty = True
 
 
-regenerate_sounds()
+# the row waves are synthesized on first use, not before the first frame
+WAVES = None
+pattern_dirty = True
+pattern_player = PatternPlayer()
+song_player = SongPlayer()
+
+
+def render_pattern_chunk(start, count, step_samples):
+    # called by the pattern player for every chunk it queues, straight from the live grid
+    if WAVES is None:
+        regenerate_sounds()
+    return render_pattern(grid, WAVES, step_samples, slider_columns, start, count)
+
+
+def play_pattern():
+    global pattern_dirty
+    pattern_dirty = False
+    pattern_player.play(render_pattern_chunk, slider_columns, step_samples_for(bps))
+
+
+def refresh_pattern():
+    # after an edit the queued chunk is rendered again; a playing loop continues from the same step
+    global pattern_dirty
+    if pattern_dirty and pattern_player.active:
+        pattern_dirty = False
+        pattern_player.refresh(slider_columns, step_samples_for(bps))
 
 
 def handle_style_selection(pos):
@@ -123,15 +171,53 @@ def handle_style_selection(pos):
         if rect.collidepoint(pos):
             current_sound_style = SOUND_STYLES[i]
             regenerate_sounds()
+            # a song still converting is mixed in whatever style is current when it finishes
+            if generated_stems is not None and song_job is None:
+                remix_generated()
             update_status(f"Switched to {current_sound_style} style")
             return True
     return False
 
 
 def update_grid_size(new_cols):
-    global grid
-    for r in range(GRID_ROWS):
-        grid[r] = grid[r][:new_cols] + [0] * max(0, new_cols - len(grid[r]))
+    global pattern_dirty
+    grid.resize(new_cols)
+    pattern_dirty = True
+    set_grid_scroll(grid_scroll)
+    invalidate_grid()
+
+
+def visible_columns():
+    return min(slider_columns, VIEW_COLUMNS)
+
+
+def set_grid_scroll(first_col):
+    '''
+    Scroll the grid so first_col is the leftmost visible column (clamped to the pattern)
+    '''
+    global grid_scroll
+    first_col = max(0, min(first_col, slider_columns - visible_columns()))
+    if first_col != grid_scroll:
+        grid_scroll = first_col
+        invalidate_grid()
+
+
+def follow_playhead(play_col):
+    # page the view along with a playing pattern once the playhead leaves it
+    if play_col is not None and pattern_player.playing and not (
+            grid_scroll <= play_col < grid_scroll + visible_columns()):
+        set_grid_scroll(play_col - play_col % visible_columns())
+
+
+def handle_grid_key(event):
+    steps = {pygame.K_LEFT: -1, pygame.K_RIGHT: 1,
+             pygame.K_PAGEUP: -visible_columns(), pygame.K_PAGEDOWN: visible_columns()}
+    if event.key in steps:
+        set_grid_scroll(grid_scroll + steps[event.key])
+    elif event.key == pygame.K_HOME:
+        set_grid_scroll(0)
+    elif event.key == pygame.K_END:
+        set_grid_scroll(slider_columns)
 
 
 def get_fixed_col_x():
@@ -152,8 +238,9 @@ def update_status(new_status, reset_after_seconds=None):
 
 def show_status_now(message):
     update_status(message)
-    draw_controls()
-    pygame.display.flip()
+    if static_layer is None:
+        build_layers()
+    pygame.display.update(draw_controls())
     pygame.time.wait(300)
 
 
@@ -182,32 +269,376 @@ download_button = pygame.Rect(1300, HEIGHT - 80, 150, 50)
 play_generated_button = pygame.Rect(1050, HEIGHT - 80, 80, 50)
 uploaded_midi = None
 generated_audio = None
+# square / triangle / noise stems of the loaded song, remixed when the style changes;
+# None while only the preview is loaded
+generated_stems = None
+# conversion_worker job of the song being opened, None once it has finished
+song_job = None
 dragging_slider = None
+# F3 toggles per-stage timings of the last conversion in the status bar
+show_stats_overlay = False
+last_conversion_stats = None
 
 
-def draw_grid(play_col=None):
-    fixed_col_x = get_fixed_col_x()
-    top_offset = (HEIGHT - GRID_ROWS * CELL_SIZE - 160) // 2
+def convert_midi(path, progress):
+    # runs on the conversion worker thread: a preview published once its first seconds are ready, then the stems
+    stats = ConversionStats() if show_stats_overlay else None
+    cache = default_cache()
+    stems = cache.cached_stems(path, dtype='float32')
+    if stems is None:
+        wave_ratios, noise_ratio = STYLE_MIXES[current_sound_style]
+        segments = render_preview(cache.load_notes(path), wave_ratios=wave_ratios, noise_ratio=noise_ratio,
+                                  progress=lambda fraction: progress(fraction * 0.25))
+        # the rest of the preview, its PCM and peaks fill in while it plays
+        conversion_worker.publish("preview", next(segments))
+        for _ in segments:
+            pass
+        stems = cache.load_stems(path, stats=stats, progress=lambda fraction: progress(0.25 + fraction * 0.75),
+                                 dtype='float32')
+    return stems, mix_song(stems, current_sound_style), stats
+
+
+def mix_song(stems, style):
+    # runs on the conversion worker thread: the style's mix with its PCM and peaks ready for the UI thread
+    wave_ratios, noise_ratio = STYLE_MIXES[style]
+    audio = GeneratedAudio(mix_stems(stems, wave_ratios, noise_ratio))
+    audio.pcm
+    audio.peaks
+    return audio
+
+
+def play_song(position=0):
+    # a preview still rendering plays up to where it is ready and waits there
+    song_player.play(generated_audio.pcm, position, lambda audio=generated_audio: audio.ready)
+
+
+def remix_generated():
+    """
+    Mix the loaded song's stems for the current style on the conversion worker;
+    handle_conversion_events swaps it in, and a playing song continues without a break
+    """
+    stems, style = generated_stems, current_sound_style
+
+    def remix(path, progress):
+        audio = mix_song(stems, style)
+        # raises when a newer style or song has replaced this job meanwhile
+        progress(1.0)
+        return stems, audio, None
+
+    conversion_worker.submit(uploaded_midi, task=remix)["remix"] = True
+
+
+conversion_worker = ConversionWorker(convert_midi)
+
+# F5 cycles the format the Download button writes
+export_choice = 0
+# (GeneratedAudio, format, bits) of the export being written, fixed when Download is clicked
+export_request = None
+
 
-    title_text = title_font.render("PixelTone - 8-bit Music Sequencer", True, (225, 225, 225))
-    screen.blit(title_text, (fixed_col_x, top_offset - 60))
+def export_generated(path, progress):
+    # runs on the export worker thread, encoding the loaded song chunk by chunk
+    audio, fmt, bits = export_request
+    return export_samples(audio.samples, path, audio.sample_rate, fmt, bits, progress=progress)
 
-    grid_surface = pygame.Surface((WIDTH, HEIGHT), pygame.SRCALPHA)
-    if play_col is not None and play_col >= 0:
-        for row in range(GRID_ROWS):
-            x = fixed_col_x + play_col * CELL_SIZE
-            y = top_offset + row * CELL_SIZE
-            pygame.draw.rect(grid_surface, HIGHLIGHT_RGBA, (x, y, CELL_SIZE, CELL_SIZE))
 
+export_worker = ConversionWorker(export_generated)
+
+
+def export_label():
+    fmt, bits = EXPORT_CHOICES[export_choice]
+    if bits is None:
+        return fmt.upper()
+    return f"{fmt.upper()} {bits}-bit float" if bits == 32 else f"{fmt.upper()} {bits}-bit"
+
+
+TEXT_CACHE_SIZE = 512
+text_cache = {}
+
+
+def render_text(text_font, text, color):
+    # labels repeat every frame, so each (font, text, color) is rendered once
+    key = (id(text_font), text, color)
+    surf = text_cache.get(key)
+    if surf is None:
+        if len(text_cache) >= TEXT_CACHE_SIZE:
+            text_cache.clear()
+        surf = text_cache[key] = text_font.render(text, True, color)
+    return surf
+
+
+def get_grid_top():
+    return (HEIGHT - GRID_ROWS * CELL_SIZE - 160) // 2
+
+
+def cell_rect(row, col):
+    # col is a pattern column; the screen shows grid_scroll onwards
+    return pygame.Rect(get_fixed_col_x() + (col - grid_scroll) * CELL_SIZE, get_grid_top() + row * CELL_SIZE,
+                       CELL_SIZE, CELL_SIZE)
+
+
+def column_rect(col):
+    # empty when the column is scrolled out of view
+    rect = pygame.Rect(get_fixed_col_x() + (col - grid_scroll) * CELL_SIZE, get_grid_top(), CELL_SIZE,
+                       GRID_ROWS * CELL_SIZE)
+    return rect.clip(grid_area_rect())
+
+
+def grid_area_rect():
+    return pygame.Rect(get_fixed_col_x(), get_grid_top(), VIEW_COLUMNS * CELL_SIZE, GRID_ROWS * CELL_SIZE)
+
+
+def scrollbar_rect():
+    area = grid_area_rect()
+    return pygame.Rect(area.x, area.bottom + 10, visible_columns() * CELL_SIZE, 8)
+
+
+def waveform_rect():
+    area = grid_area_rect()
+    return pygame.Rect(area.x, area.bottom + 45, area.width, 60)
+
+
+static_layer = None
+static_has_background = False
+grid_layer = None
+column_highlight = None
+
+
+def build_layers():
+    """
+    Cache what does not change per frame: background + title, all grid cells, the playhead overlay
+    """
+    global static_layer, grid_layer, column_highlight, static_has_background
+    static_has_background = background_image is not None
+    if static_has_background:
+        static_layer = background_image.copy()
+    else:
+        static_layer = pygame.Surface((WIDTH, HEIGHT))
+        static_layer.fill(DARK_BG)
+    title_text = render_text(title_font, "PixelTone - 8-bit Music Sequencer", (225, 225, 225))
+    static_layer.blit(title_text, (get_fixed_col_x(), get_grid_top() - 60))
+
+    column_highlight = pygame.Surface((CELL_SIZE, GRID_ROWS * CELL_SIZE), pygame.SRCALPHA)
+    column_highlight.fill(HIGHLIGHT_RGBA)
+    build_grid_layer()
+
+
+def build_grid_layer():
+    # only the columns in view are drawn, however long the pattern is
+    global grid_layer
+    grid_layer = pygame.Surface(grid_area_rect().size, pygame.SRCALPHA)
     for row in range(GRID_ROWS):
-        for col in range(slider_columns):
-            x = fixed_col_x + col * CELL_SIZE
-            y = top_offset + row * CELL_SIZE
-            cell_color = DARK_BG if not grid[row][col] else ACTIVE_CELL
-            pygame.draw.rect(screen, cell_color, (x, y, CELL_SIZE, CELL_SIZE), border_radius=4)
-            pygame.draw.rect(screen, LIGHT_GRID, (x, y, CELL_SIZE, CELL_SIZE), 1)
+        for col in range(grid_scroll, grid_scroll + visible_columns()):
+            draw_cell(row, col)
+
+
+def draw_cell(row, col):
+    # redraw one cell of the cached grid layer, e.g. after a toggle
+    rect = pygame.Rect((col - grid_scroll) * CELL_SIZE, row * CELL_SIZE, CELL_SIZE, CELL_SIZE)
+    grid_layer.fill((0, 0, 0, 0), rect)
+    cell_color = DARK_BG if not grid[row, col] else ACTIVE_CELL
+    pygame.draw.rect(grid_layer, cell_color, rect, border_radius=4)
+    pygame.draw.rect(grid_layer, LIGHT_GRID, rect, 1)
+
+
+def draw_region(rect, play_col=None):
+    """
+    Recompose one screen region from the cached layers, return it as a dirty rect
+    """
+    rect = rect.clip(screen.get_rect())
+    screen.blit(static_layer, rect, rect)
+    area = grid_area_rect()
+    overlap = rect.clip(area)
+    if overlap.width and overlap.height:
+        screen.blit(grid_layer, overlap, overlap.move(-area.x, -area.y))
+        if play_col is not None and play_col >= 0:
+            highlight = column_rect(play_col)
+            if highlight.colliderect(overlap):
+                screen.set_clip(overlap)
+                screen.blit(column_highlight, highlight)
+                screen.set_clip(None)
+    return rect
+
 
-    screen.blit(grid_surface, (0, 0))
+def draw_grid(play_col=None):
+    return draw_region(screen.get_rect(), play_col)
+
+
+def draw_grid_scrollbar():
+    # part of the full redraw, which every scroll or column change triggers
+    if slider_columns <= VIEW_COLUMNS:
+        return
+    bar = scrollbar_rect()
+    pygame.draw.rect(screen, LIGHT_GRID, bar, border_radius=4)
+    thumb = pygame.Rect(bar.x + bar.width * grid_scroll // slider_columns, bar.y,
+                        max(8, bar.width * visible_columns() // slider_columns), bar.height)
+    pygame.draw.rect(screen, HIGHLIGHT_RGBA[:3], thumb, border_radius=4)
+    label = render_text(small_font, f"Columns {grid_scroll + 1}-{grid_scroll + visible_columns()} of {slider_columns}",
+                        BUTTON_TEXT)
+    screen.blit(label, (bar.x, bar.bottom + 6))
+
+
+needs_full_redraw = True
+dirty_cells = []
+shown_play_col = None
+shown_controls_state = None
+
+
+def invalidate_grid():
+    # column count changed or grid cleared: rebuild the cell layer and repaint everything once
+    global needs_full_redraw
+    if grid_layer is not None:
+        build_grid_layer()
+    needs_full_redraw = True
+
+
+# waveform of the loaded song: first sample shown and zoom, None = whole song
+waveform_start = 0
+waveform_spp = None
+waveform_surface = None
+waveform_surface_key = None
+shown_waveform_state = None
+
+
+def reset_waveform_view():
+    global waveform_start, waveform_spp
+    waveform_start, waveform_spp = 0, None
+
+
+def waveform_samples_per_pixel():
+    fit = max(1.0, len(generated_audio) / waveform_rect().width)
+    return fit if waveform_spp is None else min(waveform_spp, fit)
+
+
+def waveform_playhead_x():
+    if not song_player.playing:
+        return None
+    x = int((song_player.position() - waveform_start) / waveform_samples_per_pixel())
+    return x if 0 <= x < waveform_rect().width else None
+
+
+def waveform_state():
+    '''
+    Everything draw_waveform depends on; None when no song is loaded
+    '''
+    if generated_audio is None:
+        return None
+    return (id(generated_audio), generated_audio.ready, waveform_start, waveform_samples_per_pixel(),
+            waveform_playhead_x())
+
+
+def set_waveform_view(start, samples_per_pixel):
+    global waveform_start, waveform_spp
+    rect = waveform_rect()
+    fit = max(1.0, len(generated_audio) / rect.width)
+    waveform_spp = max(1.0, min(samples_per_pixel, fit))
+    waveform_start = int(max(0, min(start, len(generated_audio) - rect.width * waveform_spp)))
+
+
+def zoom_waveform(steps, mouse_x):
+    # zoom around the sample under the mouse
+    spp = waveform_samples_per_pixel()
+    offset = mouse_x - waveform_rect().x
+    anchor = waveform_start + offset * spp
+    new_spp = spp * 0.75 ** steps
+    set_waveform_view(anchor - offset * new_spp, new_spp)
+
+
+def follow_song_playhead():
+    # page the zoomed waveform along with the playing song
+    if generated_audio is not None and song_player.playing and waveform_playhead_x() is None:
+        set_waveform_view(song_player.position(), waveform_samples_per_pixel())
+
+
+def draw_waveform():
+    '''
+    Min/max waveform of the visible part of the song, read from its peak pyramid, plus the playhead
+    '''
+    global waveform_surface, waveform_surface_key
+    rect = waveform_rect()
+    spp = waveform_samples_per_pixel()
+    key = (id(generated_audio), waveform_start, spp)
+    if key != waveform_surface_key:
+        mins, maxs = generated_audio.peaks.columns(waveform_start, spp, rect.width)
+        middle = rect.height / 2
+        top = np.rint(middle - maxs * (middle - 1) * 1.4).astype(np.int32)[:, None]
+        bottom = np.rint(middle - mins * (middle - 1) * 1.4).astype(np.int32)[:, None]
+        rows = np.arange(rect.height)[None, :]
+        waveform_surface = pygame.Surface(rect.size)
+        waveform_surface.fill((20, 20, 20))
+        pixels = pygame.surfarray.pixels3d(waveform_surface)
+        pixels[(rows >= top) & (rows <= bottom)] = BUTTON_UPLOAD
+        del pixels
+        waveform_surface_key = key
+    screen.blit(waveform_surface, rect)
+    playhead = waveform_playhead_x()
+    if playhead is not None:
+        pygame.draw.line(screen, ACTIVE_CELL, (rect.x + playhead, rect.y), (rect.x + playhead, rect.bottom - 1), 2)
+    return rect
+
+
+def toggle_cell(row, col):
+    grid.toggle(row, col)
+    if grid_layer is not None:
+        draw_cell(row, col)
+        dirty_cells.append((row, col))
+
+
+def present_frame():
+    """
+    Push only what changed: toggled cells, the old and new playhead column and the control panel.
+    Invalidations and changes to the file browser overlay fall back to a full redraw.
+    """
+    global needs_full_redraw, shown_play_col, shown_controls_state, shown_browser_state, shown_waveform_state
+    if static_layer is None or (background_image is not None and not static_has_background):
+        build_layers()
+        needs_full_redraw = True
+    play_col = pattern_player.current_step()
+    follow_playhead(play_col)
+    follow_song_playhead()
+    if file_browser_active:
+        state = (browser_state(), play_col, controls_state(), waveform_state())
+        if state == shown_browser_state and not needs_full_redraw:
+            return
+        shown_browser_state = state
+        needs_full_redraw = True
+    elif shown_browser_state is not None:
+        # the browser was just closed: one full frame uncovers the grid again
+        shown_browser_state = None
+        needs_full_redraw = True
+    if needs_full_redraw:
+        draw_grid(play_col)
+        draw_grid_scrollbar()
+        if generated_audio is not None:
+            draw_waveform()
+        draw_controls()
+        if file_browser_active:
+            draw_file_browser()
+        pygame.display.flip()
+        needs_full_redraw = False
+        dirty_cells.clear()
+        shown_play_col = play_col
+        shown_controls_state = controls_state()
+        shown_waveform_state = waveform_state()
+        return
+
+    dirty = [draw_region(cell_rect(row, col), play_col) for row, col in dirty_cells]
+    dirty_cells.clear()
+    if play_col != shown_play_col:
+        for col in (shown_play_col, play_col):
+            if col is not None and column_rect(col):
+                dirty.append(draw_region(column_rect(col), play_col))
+        shown_play_col = play_col
+    state = controls_state()
+    if state != shown_controls_state:
+        dirty += draw_controls()
+        shown_controls_state = state
+    state = waveform_state()
+    if state != shown_waveform_state:
+        dirty.append(draw_waveform())
+        shown_waveform_state = state
+    if dirty:
+        pygame.display.update(dirty)
 
 
 def draw_button(rect, text, bg_color, text_color=BUTTON_TEXT, enabled=True):
@@ -217,115 +648,260 @@ def draw_button(rect, text, bg_color, text_color=BUTTON_TEXT, enabled=True):
     color = tuple(min(255, c + 30) for c in bg_color) if rect.collidepoint(
         pygame.mouse.get_pos()) and enabled else bg_color
     pygame.draw.rect(screen, color, rect, border_radius=10)
-    label = font.render(text, True, text_color)
+    label = render_text(font, text, text_color)
     screen.blit(label, (rect.centerx - label.get_width() // 2, rect.centery - label.get_height() // 2))
 
 
-def draw_slider(x, y, width, value, min_val, max_val, label):
+def slider_fraction(value, min_val, max_val, log_scale=False):
+    if log_scale:
+        return math.log(value / min_val) / math.log(max_val / min_val)
+    return (value - min_val) / (max_val - min_val)
+
+
+def slider_value(fraction, min_val, max_val, log_scale=False):
+    fraction = max(0.0, min(1.0, fraction))
+    if log_scale:
+        return int(round(min_val * (max_val / min_val) ** fraction))
+    return min_val + int(fraction * (max_val - min_val))
+
+
+def draw_slider(x, y, width, value, min_val, max_val, label, log_scale=False):
     pygame.draw.rect(screen, LIGHT_GRID, (x, y, width, 10), border_radius=5)
-    knob_x = int(x + (value - min_val) / (max_val - min_val) * width)
+    knob_x = int(x + slider_fraction(value, min_val, max_val, log_scale) * width)
     pygame.draw.circle(screen, HIGHLIGHT_RGBA[:3], (knob_x, y + 5), 8)
-    label_surf = font.render(f"{label}: {value}", True, BUTTON_TEXT)
+    label_surf = render_text(font, f"{label}: {value}", BUTTON_TEXT)
     screen.blit(label_surf, (x + width + 20, y - 10))
 
 
+FILE_BROWSER_ROWS = 20
+FILE_BROWSER_TOP = 180
+FILE_BROWSER_ROW_HEIGHT = 30
+directory_cache = DirectoryCache()
+file_browser_filter = ""
+file_browser_midi_only = False
+shown_browser_state = None
+
+
+def browser_entries():
+    """
+    Filtered listing of current_dir; row 0 of the browser is "../", row i is entries[i - 1]
+    """
+    listing = directory_cache.get(current_dir)
+    return listing, listing.view(file_browser_filter, file_browser_midi_only)
+
+
+def browser_hovered_row():
+    mouse_x, mouse_y = pygame.mouse.get_pos()
+    if 120 <= mouse_x <= WIDTH - 100 and FILE_BROWSER_TOP <= mouse_y < FILE_BROWSER_TOP + FILE_BROWSER_ROWS * FILE_BROWSER_ROW_HEIGHT:
+        return (mouse_y - FILE_BROWSER_TOP) // FILE_BROWSER_ROW_HEIGHT
+    return None
+
+
+def browser_state():
+    """
+    Everything draw_file_browser depends on; the overlay is only redrawn when this changes
+    """
+    listing, entries = browser_entries()
+    return (current_dir, listing.version, listing.loading, len(entries), file_browser_scroll, file_browser_filter,
+            file_browser_midi_only, browser_hovered_row())
+
+
+def scroll_file_browser(delta):
+    global file_browser_scroll
+    _, entries = browser_entries()
+    max_scroll = max(0, len(entries) + 1 - FILE_BROWSER_ROWS)
+    file_browser_scroll = max(0, min(file_browser_scroll + delta, max_scroll))
+
+
+def set_browser_filter(text=None, midi_only=None):
+    global file_browser_filter, file_browser_midi_only, file_browser_scroll
+    if text is not None:
+        file_browser_filter = text
+    if midi_only is not None:
+        file_browser_midi_only = midi_only
+    file_browser_scroll = 0
+
+
+def change_directory(path):
+    global current_dir
+    current_dir = path
+    set_browser_filter(text="")
+
+
 def draw_file_browser():
-    global current_dir, file_browser_scroll
     pygame.draw.rect(screen, (30, 30, 30), (100, 100, WIDTH - 200, HEIGHT - 200))
     pygame.draw.rect(screen, (255, 255, 255), (100, 100, WIDTH - 200, HEIGHT - 200), 2)
 
-    title = font.render("Select a MIDI File", True, (255, 255, 255))
+    title = render_text(font, "Select a MIDI File", (255, 255, 255))
     screen.blit(title, (120, 110))
-    path_surf = small_font.render(current_dir, True, (200, 200, 200))
+    path_surf = render_text(small_font, current_dir, (200, 200, 200))
     screen.blit(path_surf, (120, 150))
 
-    try:
-        all_items = ["../"] + sorted(os.listdir(current_dir))
-        items = []
-        for item in all_items:
-            full_path = os.path.abspath(os.path.join(current_dir, item))
-            if os.access(full_path, os.R_OK):
-                items.append(item)
-    except PermissionError:
-        items = ["../"]
-
-    visible_items = items[file_browser_scroll:file_browser_scroll + 20]
-    mouse_x, mouse_y = pygame.mouse.get_pos()
-
-    for i, item in enumerate(visible_items):
-        full_path = os.path.abspath(os.path.join(current_dir, item))
-        y = 180 + i * 30
-        if 120 <= mouse_x <= WIDTH - 100 and y <= mouse_y <= y + 30:
-            pygame.draw.rect(screen, (80, 80, 80), (120, y, WIDTH - 240, 30))
-
-        if item == "../":
+    listing, entries = browser_entries()
+    if listing.loading:
+        info = f"Loading... {len(listing.entries)} entries"
+    elif listing.error is not None:
+        info = f"Cannot list folder: {listing.error.strerror or listing.error}"
+    else:
+        info = f"{len(listing.entries)} entries, {listing.midi_count} .mid"
+    info += f" | filter: {file_browser_filter or '(type to filter)'} | Tab: {'all files' if file_browser_midi_only else '.mid only'}"
+    info_surf = small_font.render(info, True, (200, 200, 200))
+    screen.blit(info_surf, (WIDTH - 120 - info_surf.get_width(), 118))
+
+    # only the rows on screen are looked at, however large the folder is
+    hovered = browser_hovered_row()
+    for i in range(FILE_BROWSER_ROWS):
+        index = file_browser_scroll + i
+        if index > len(entries):
+            break
+        y = FILE_BROWSER_TOP + i * FILE_BROWSER_ROW_HEIGHT
+        if i == hovered:
+            pygame.draw.rect(screen, (80, 80, 80), (120, y, WIDTH - 240, FILE_BROWSER_ROW_HEIGHT))
+
+        if index == 0:
             color = (255, 255, 150)
             label = "[../] (Up)"
-        elif os.path.isdir(full_path):
-            color = (255, 215, 0)
-            label = f"[{item}]"
-        elif item.endswith(".mid"):
-            color = (150, 255, 150)
-            label = item
         else:
-            color = (120, 120, 120)
-            label = item
+            item, is_dir = entries[index - 1]
+            if is_dir:
+                color = (255, 215, 0)
+                label = f"[{item}]"
+            elif item.endswith(".mid"):
+                color = (150, 255, 150)
+                label = item
+            else:
+                color = (120, 120, 120)
+                label = item
 
-        text = small_font.render(label, True, color)
+        text = render_text(small_font, label, color)
         screen.blit(text, (130, y + 5))
 
 
+def open_browser_row(row):
+    """
+    Act on a click in the file browser: go up, enter a folder or start converting a .mid
+    """
+    global file_browser_active, song_job
+    index = row + file_browser_scroll
+    _, entries = browser_entries()
+    if index == 0:
+        parent_path = os.path.abspath(os.path.join(current_dir, ".."))
+        if os.access(parent_path, os.R_OK):
+            change_directory(parent_path)
+        else:
+            update_status("Access denied to parent directory", reset_after_seconds=4)
+        return
+    if not 0 < index <= len(entries):
+        return
+    selected, is_dir = entries[index - 1]
+    selected_path = os.path.abspath(os.path.join(current_dir, selected))
+    if is_dir:
+        if os.access(selected_path, os.R_OK):
+            change_directory(selected_path)
+        else:
+            update_status(f"Access denied to: {selected}", reset_after_seconds=4)
+    elif selected.endswith(".mid"):
+        if os.access(selected_path, os.R_OK):
+            song_job = conversion_worker.submit(selected_path)
+            update_status(f"Converting {selected}... (Esc to cancel)")
+            file_browser_active = False
+        else:
+            update_status(f"Cannot open file: {selected}", reset_after_seconds=4)
+
+
+def handle_browser_key(event):
+    """
+    Typing filters the listing; Tab toggles .mid only, arrows / page keys scroll, Esc closes
+    """
+    global file_browser_active
+    if event.key == pygame.K_ESCAPE:
+        file_browser_active = False
+    elif event.key == pygame.K_BACKSPACE:
+        set_browser_filter(text=file_browser_filter[:-1])
+    elif event.key == pygame.K_TAB:
+        set_browser_filter(midi_only=not file_browser_midi_only)
+    elif event.key == pygame.K_UP:
+        scroll_file_browser(-1)
+    elif event.key == pygame.K_DOWN:
+        scroll_file_browser(1)
+    elif event.key == pygame.K_PAGEUP:
+        scroll_file_browser(-FILE_BROWSER_ROWS)
+    elif event.key == pygame.K_PAGEDOWN:
+        scroll_file_browser(FILE_BROWSER_ROWS)
+    elif event.key == pygame.K_HOME:
+        scroll_file_browser(-file_browser_scroll)
+    elif event.key == pygame.K_END:
+        scroll_file_browser(len(browser_entries()[1]))
+    elif event.key == pygame.K_RETURN:
+        # open the first match, so typing part of a name and Enter is enough
+        if browser_entries()[1]:
+            open_browser_row(1 - file_browser_scroll)
+    elif event.unicode and event.unicode.isprintable():
+        set_browser_filter(text=file_browser_filter + event.unicode)
+
+
+CONTROL_PANEL_RECT = pygame.Rect(0, HEIGHT - 140, WIDTH, 140)
+STYLE_PANEL_RECT = style_buttons[0].unionall(style_buttons[1:])
+
+
+def current_progress():
+    """
+    Fraction done of the running conversion or export, None when neither is running
+    """
+    progress = conversion_worker.progress
+    return export_worker.progress if progress is None else progress
+
+
+def controls_state():
+    """
+    Everything draw_controls depends on; the panel is only redrawn when this changes
+    """
+    mouse = pygame.mouse.get_pos()
+    hovered = next((i for i, rect in enumerate(
+        [play_button, stop_button, clear_button, cancel_generated_button, upload_button, download_button,
+         play_generated_button]) if rect.collidepoint(mouse)), None)
+    progress = current_progress()
+    return (hovered, status_message, slider_columns, slider_bps, current_sound_style, is_generated_audio_playing,
+            None if progress is None else round(progress, 3), show_stats_overlay, id(last_conversion_stats))
+
+
 def draw_controls():
-    pygame.draw.rect(screen, (20, 20, 20), pygame.Rect(0, HEIGHT - 140, WIDTH, 160))
+    pygame.draw.rect(screen, (20, 20, 20), CONTROL_PANEL_RECT)
     draw_button(play_button, "Play", BUTTON_PLAY)
     draw_button(stop_button, "Stop", BUTTON_STOP)
     draw_button(clear_button, "Clear", BUTTON_CLEAR)
-    if is_generated_audio_playing:
-        draw_button(cancel_generated_button, "stop", BUTTON_STOP, enabled=True)
-        draw_button(play_generated_button, "Play", BUTTON_PLAY, enabled=False)
-        draw_button(upload_button, "Upload", BUTTON_UPLOAD, enabled=False)
-        draw_button(download_button, "Save", BUTTON_DOWNLOAD, text_color=(200, 200, 200), enabled=False)
-    else:
-        draw_button(play_generated_button, "Play", BUTTON_PLAY)
-        draw_button(upload_button, "Upload", BUTTON_UPLOAD)
-        draw_button(download_button, "Save", BUTTON_DOWNLOAD, text_color=(20, 20, 20))
-        draw_button(cancel_generated_button, "stop", BUTTON_STOP, enabled=False)
+    draw_button(cancel_generated_button, "stop", BUTTON_STOP, enabled=is_generated_audio_playing)
+    draw_button(upload_button, "Upload", BUTTON_UPLOAD)
+    draw_button(download_button, "Download", BUTTON_DOWNLOAD, text_color=(20, 20, 20))
+    draw_button(play_generated_button, "play", BUTTON_PLAY)
 
-    draw_slider(490, HEIGHT - 80, 300, slider_columns, SLIDER_MIN_COLUMNS, SLIDER_MAX_COLUMNS, "Col")
+    draw_slider(490, HEIGHT - 80, 300, slider_columns, SLIDER_MIN_COLUMNS, SLIDER_MAX_COLUMNS, "Col", log_scale=True)
     draw_slider(490, HEIGHT - 40, 300, slider_bps, SLIDER_MIN_BPS, SLIDER_MAX_BPS, "BPS")
 
-    status_text = small_font.render(status_message, True, BUTTON_TEXT)
+    status_text = render_text(small_font, status_message, BUTTON_TEXT)
     status_x = play_generated_button.x + 10
     status_y = play_generated_button.y - 25
     screen.blit(status_text, (status_x, status_y))
 
+    screen.blit(static_layer, STYLE_PANEL_RECT, STYLE_PANEL_RECT)
     for i, rect in enumerate(style_buttons):
         style = SOUND_STYLES[i]
         pygame.draw.rect(screen, BUTTON_SELECTED if style == current_sound_style else BUTTON_STYLE, rect,
                          border_radius=6)
-        label = small_font.render(style, True, BUTTON_TEXT)
+        label = render_text(small_font, style, BUTTON_TEXT)
         screen.blit(label, (rect.centerx - label.get_width() // 2, rect.centery - label.get_height() // 2))
 
-    # draw_slider(490, HEIGHT - 80, 300, slider_columns, SLIDER_MIN_COLUMNS, SLIDER_MAX_COLUMNS, "Columns")
-    # draw_slider(490, HEIGHT - 40, 300, slider_bps, SLIDER_MIN_BPS, SLIDER_MAX_BPS, "BPS")
-
-    draw_button(upload_button, "Upload", BUTTON_UPLOAD)
-    draw_button(download_button, "Download", BUTTON_DOWNLOAD, text_color=(20, 20, 20))
-    draw_button(play_generated_button, "play", BUTTON_PLAY)
-
-    # draw_slider(470, HEIGHT - 80, 300, slider_columns, SLIDER_MIN_COLUMNS, SLIDER_MAX_COLUMNS, "Columns")
-    # draw_slider(470, HEIGHT - 40, 300, slider_bps, SLIDER_MIN_BPS, SLIDER_MAX_BPS, "BPS")
-    status_text = small_font.render(status_message, True, BUTTON_TEXT)
-    status_x = play_generated_button.x + 10
-    status_y = play_generated_button.y - 25
-    screen.blit(status_text, (status_x, status_y))
+    progress = current_progress()
+    if progress is not None:
+        bar = pygame.Rect(status_x, status_y - 20, WIDTH - status_x - 50, 10)
+        pygame.draw.rect(screen, LIGHT_GRID, bar, border_radius=5)
+        pygame.draw.rect(screen, BUTTON_UPLOAD, (bar.x, bar.y, int(bar.width * progress), bar.height), border_radius=5)
 
-    for i, rect in enumerate(style_buttons):
-        style = SOUND_STYLES[i]
-        pygame.draw.rect(screen, BUTTON_SELECTED if style == current_sound_style else BUTTON_STYLE, rect,
-                         border_radius=6)
-        label = small_font.render(style, True, BUTTON_TEXT)
-        screen.blit(label, (rect.centerx - label.get_width() // 2, rect.centery - label.get_height() // 2))
+    if show_stats_overlay:
+        text = last_conversion_stats.summary() if last_conversion_stats else "Stats on: load a MIDI file to measure it"
+        stats_surf = render_text(small_font, text, (150, 220, 255))
+        screen.blit(stats_surf, (50, HEIGHT - 125))
+    return [CONTROL_PANEL_RECT, STYLE_PANEL_RECT]
 
 
 def upload_midi():
@@ -334,42 +910,92 @@ def upload_midi():
 
 
 def download_audio():
-    global current_dir, uploaded_midi, generated_audio
-
+    global export_request
     if generated_audio is not None and uploaded_midi is not None:
-
+        if generated_stems is None:
+            update_status("Still refining, save once the song is loaded" if conversion_worker.busy
+                          else "Only a preview is loaded, open the song again to save it", reset_after_seconds=4)
+            return
+        if export_worker.busy:
+            update_status("Export already running", reset_after_seconds=4)
+            return
         filename = os.path.splitext(os.path.basename(uploaded_midi))[0]
-        save_path = os.path.join(current_dir, f"{filename}_converted.wav")
-
-        try:
-            sf.write(save_path, generated_audio, samplerate=44100)
-            update_status(f"Saved to {filename}_converted.wav", reset_after_seconds=6)
-        except Exception as e:
-            update_status(f"Save failed: {e}", reset_after_seconds=6)
+        fmt, bits = EXPORT_CHOICES[export_choice]
+        export_request = (generated_audio, fmt, bits)
+        export_worker.submit(os.path.join(current_dir, f"{filename}_converted.{fmt}"))
+        update_status(f"Saving {filename}_converted.{fmt} ({export_label()})...")
     else:
         update_status("No audio to save.", reset_after_seconds=4)
 
 
-def play_column(col):
-    for row in range(GRID_ROWS):
-        if col < len(grid[row]) and grid[row][col] == 1:
-            SOUNDS[row].play()
+def handle_export_events():
+    for kind, job, payload in export_worker.poll():
+        name = os.path.basename(job["path"])
+        if kind == "done":
+            update_status(f"Saved to {name}", reset_after_seconds=6)
+        elif kind == "error":
+            update_status(f"Save failed: {payload}", reset_after_seconds=6)
+
+
+def handle_conversion_events():
+    global generated_audio, generated_stems, uploaded_midi, last_conversion_stats, song_job
+    for kind, job, payload in conversion_worker.poll():
+        name = os.path.basename(job["path"])
+        if job is song_job and kind != "preview":
+            song_job = None
+        if job.get("remix"):
+            if kind == "done":
+                generated_stems, generated_audio, _ = payload
+                if song_player.playing:
+                    song_player.swap(generated_audio.pcm)
+            continue
+        if kind == "preview":
+            song_player.stop()
+            generated_audio, generated_stems = payload, None
+            reset_waveform_view()
+            uploaded_midi = job["path"]
+            job["previewed"] = True
+            update_status(f"Preview of {name} ready, refining... (Esc to cancel)")
+        elif kind == "done":
+            # after a preview the playing song moves over to the refined mix; otherwise it is a new song
+            if not job.get("previewed"):
+                song_player.stop()
+                reset_waveform_view()
+            generated_stems, generated_audio, last_conversion_stats = payload
+            if song_player.playing:
+                song_player.swap(generated_audio.pcm)
+            uploaded_midi = job["path"]
+            update_status(f"{name} loaded.")
+        elif job.get("previewed") and generated_audio.ready < len(generated_audio):
+            # stopped while the preview was still rendering: keep what is there, so playback does not wait for the rest
+            generated_audio = generated_audio.rendered()
+            if song_player.playing:
+                song_player.swap(generated_audio.pcm)
+        if kind == "error":
+            print(payload)
+            update_status(f"Conversion failed: {payload}", reset_after_seconds=6)
+        elif kind == "cancelled" and not conversion_worker.busy:
+            update_status(f"Conversion of {name} cancelled", reset_after_seconds=4)
 
 
 def handle_mouse_click(pos):
-    global is_playing, playbar_x, slider_columns, slider_bps, grid, bps, playbar_interval, dragging_slider, last_update_time, current_sound_style, generated_audio, uploaded_mid, is_generated_audio_playing
-    global is_playing, playbar_x, slider_columns, slider_bps, grid, bps, playbar_interval, dragging_slider, last_update_time, current_sound_style, generated_audio
+    global slider_columns, slider_bps, grid, bps, dragging_slider, current_sound_style, generated_audio, uploaded_mid, is_generated_audio_playing, pattern_dirty
     x, y = pos
 
-    if pygame.mixer.get_busy() and (
+    generated_busy = song_player.playing
+    if generated_busy and (
             play_generated_button.collidepoint(x, y) or
             upload_button.collidepoint(x, y) or
             download_button.collidepoint(x, y)
     ):
         return
 
-    if cancel_generated_button.collidepoint(x, y) and pygame.mixer.get_busy():
-        pygame.mixer.stop()
+    if cancel_generated_button.collidepoint(x, y) and conversion_worker.busy:
+        conversion_worker.cancel()
+        return
+
+    if cancel_generated_button.collidepoint(x, y) and generated_busy:
+        song_player.stop()
         is_generated_audio_playing = False
         update_status("Playback stopped", reset_after_seconds=4)
         return
@@ -380,17 +1006,9 @@ def handle_mouse_click(pos):
     if play_generated_button.collidepoint(x, y):
         try:
             if generated_audio is not None:
-                mono = (generated_audio * 32767).astype(np.int16)
-
-                stereo = np.stack([mono, mono], axis=1)
-                sound = pygame.sndarray.make_sound(stereo)
-                sound.play()
+                play_song()
                 is_generated_audio_playing = True
 
-                stereo = np.stack([mono, mono], axis=1)  # shape: (samples, 2)
-                sound = pygame.sndarray.make_sound(stereo)
-                sound.play()
-
                 update_status("Playing generated audio", reset_after_seconds=5)
             else:
                 update_status("No generated audio to play", reset_after_seconds=4)
@@ -398,21 +1016,17 @@ def handle_mouse_click(pos):
             update_status(f"Play error: {e}", reset_after_seconds=4)
 
     elif play_button.collidepoint(x, y):
-        if playbar_x is None:
-            playbar_x = get_fixed_col_x()
-            last_update_time = time.time()
-            play_column(0)
-        is_playing = True
+        if not pattern_player.playing:
+            play_pattern()
 
     elif stop_button.collidepoint(x, y):
-        is_playing = False
+        pattern_player.stop()
 
     elif clear_button.collidepoint(x, y):
-        is_playing = False
-        for r in range(GRID_ROWS):
-            for c in range(slider_columns):
-                grid[r][c] = 0
-        playbar_x = None
+        pattern_player.reset()
+        grid.clear()
+        pattern_dirty = True
+        invalidate_grid()
 
     elif slider_columns_box.collidepoint(x, y):
         dragging_slider = "columns"
@@ -426,44 +1040,59 @@ def handle_mouse_click(pos):
     elif download_button.collidepoint(x, y):
         download_audio()
 
+    elif generated_audio is not None and waveform_rect().collidepoint(x, y):
+        # play the song from the clicked spot
+        position = int(waveform_start + (x - waveform_rect().x) * waveform_samples_per_pixel())
+        play_song(min(position, len(generated_audio) - 1))
+        is_generated_audio_playing = True
+
+    elif slider_columns > VIEW_COLUMNS and scrollbar_rect().inflate(0, 10).collidepoint(x, y):
+        # jump so the clicked spot is in the middle of the view
+        bar = scrollbar_rect()
+        set_grid_scroll((x - bar.x) * slider_columns // bar.width - visible_columns() // 2)
+
     else:
         fixed_col_x = get_fixed_col_x()
         top_offset = (HEIGHT - GRID_ROWS * CELL_SIZE - 160) // 2
         col = (x - fixed_col_x) // CELL_SIZE
         row = (y - top_offset) // CELL_SIZE
-        if 0 <= row < GRID_ROWS and 0 <= col < slider_columns:
-            grid[row][col] = 1 - grid[row][col]
+        if 0 <= row < GRID_ROWS and 0 <= col < visible_columns():
+            toggle_cell(row, grid_scroll + col)
+            pattern_dirty = True
 
 
 def main():
-    global playbar_x, last_update_time, is_playing, slider_columns, slider_bps, bps, playbar_interval, dragging_slider, status_reset_delay, file_browser_active, file_browser_scroll, current_dir, generated_audio, uploaded_midi, is_generated_audio_playing, file_browser_active, file_browser_scroll, current_dir, generated_audio, uploaded_midi
+    global slider_columns, slider_bps, bps, pattern_dirty, dragging_slider, status_reset_delay, needs_full_redraw, show_stats_overlay, export_choice, file_browser_active, file_browser_scroll, current_dir, uploaded_midi, is_generated_audio_playing, file_browser_active, file_browser_scroll, current_dir, generated_audio, uploaded_midi
+    clock = pygame.time.Clock()
     running = True
     while running:
-        screen.blit(background_image, (0, 0))
-        col = (playbar_x - get_fixed_col_x()) // CELL_SIZE if playbar_x is not None else None
-        draw_grid(col)
-        draw_controls()
-        if file_browser_active:
-            draw_file_browser()
+        refresh_pattern()
+        pattern_player.update()
+        handle_conversion_events()
+        handle_export_events()
+        song_player.update()
+        is_generated_audio_playing = song_player.playing
 
         if status_reset_delay and time.time() - status_last_update > status_reset_delay:
             update_status("Waiting for user action...")
             status_reset_delay = 0
 
-        if is_playing and playbar_x is not None:
-            current_time = time.time()
-            if current_time - last_update_time >= playbar_interval:
-                last_update_time = current_time
-                playbar_x += CELL_SIZE
-                col = (playbar_x - get_fixed_col_x()) // CELL_SIZE
-                if 0 <= col < slider_columns:
-                    play_column(col)
-                if col >= slider_columns:
-                    playbar_x = get_fixed_col_x()
-
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 running = False
+            elif event.type in (pygame.VIDEORESIZE, pygame.VIDEOEXPOSE):
+                needs_full_redraw = True
+            elif event.type == pygame.KEYDOWN and file_browser_active:
+                handle_browser_key(event)
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                show_stats_overlay = not show_stats_overlay
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F5:
+                export_choice = (export_choice + 1) % len(EXPORT_CHOICES)
+                update_status(f"Download saves {export_label()} (F5 to change)", reset_after_seconds=4)
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE and conversion_worker.busy:
+                conversion_worker.cancel()
+            elif event.type == pygame.KEYDOWN:
+                handle_grid_key(event)
             # elif event.type == pygame.MOUSEBUTTONDOWN:
             #     handle_mouse_click(event.pos)
             elif event.type == pygame.MOUSEBUTTONUP:
@@ -471,66 +1100,42 @@ def main():
             elif event.type == pygame.MOUSEMOTION and dragging_slider:
                 x = event.pos[0]
                 if dragging_slider == "columns":
-                    slider_columns = max(SLIDER_MIN_COLUMNS, min(SLIDER_MAX_COLUMNS, SLIDER_MIN_COLUMNS + int(
-                        (x - 470) / 300 * (SLIDER_MAX_COLUMNS - SLIDER_MIN_COLUMNS))))
-                    update_grid_size(slider_columns)
+                    columns = slider_value((x - 470) / 300, SLIDER_MIN_COLUMNS, SLIDER_MAX_COLUMNS, log_scale=True)
+                    if columns != slider_columns:
+                        slider_columns = columns
+                        update_grid_size(slider_columns)
                 elif dragging_slider == "bps":
                     slider_bps = max(SLIDER_MIN_BPS, min(SLIDER_MAX_BPS, SLIDER_MIN_BPS + int(
                         (x - 470) / 300 * (SLIDER_MAX_BPS - SLIDER_MIN_BPS))))
                     bps = slider_bps
-                    playbar_interval = 1 / bps
+                    pattern_dirty = True
             elif event.type == pygame.MOUSEBUTTONDOWN and file_browser_active:
-                x, y = event.pos
-                if 120 <= x <= WIDTH - 100 and 180 <= y <= HEIGHT - 100:
-                    index = (y - 180) // 30 + file_browser_scroll
-                    try:
-                        items = ["../"] + sorted(os.listdir(current_dir))
-                        if 0 <= index < len(items):
-                            selected = items[index]
-                            selected_path = os.path.abspath(os.path.join(current_dir, selected))
-
-                            if selected == "../":
-                                parent_path = os.path.abspath(os.path.join(current_dir, ".."))
-                                if os.access(parent_path, os.R_OK):
-                                    current_dir = parent_path
-                                    file_browser_scroll = 0
-                                else:
-                                    update_status("Access denied to parent directory", reset_after_seconds=4)
-
-                            elif os.path.isdir(selected_path):
-                                if os.access(selected_path, os.R_OK):
-                                    current_dir = selected_path
-                                    file_browser_scroll = 0
-                                else:
-                                    update_status(f"Access denied to: {selected}", reset_after_seconds=4)
-
-                            elif selected.endswith(".mid"):
-                                if os.access(selected_path, os.R_OK):
-                                    notes = parse_midi(selected_path)
-                                    generated_audio = generate_audio(notes)
-                                    # sound = pygame.mixer.Sound(
-                                    #     buffer=(generated_audio * 32767).astype(np.int16).tobytes())
-                                    # sound.play()
-                                    uploaded_midi = selected_path
-                                    update_status(f"{selected} loaded.")
-                                    file_browser_active = False
-                                else:
-                                    update_status(f"Cannot open file: {selected}", reset_after_seconds=4)
-                    except Exception as e:
-                        print(e)
-                        update_status(f"Access error: {str(e)}", reset_after_seconds=4)
+                if event.button in (1, 2, 3):
+                    row = browser_hovered_row()
+                    if row is not None:
+                        open_browser_row(row)
 
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 handle_mouse_click(event.pos)
 
             elif event.type == pygame.MOUSEWHEEL and file_browser_active:
-                try:
-                    max_items = len(["../"] + sorted(os.listdir(current_dir)))
-                    file_browser_scroll = max(0, min(file_browser_scroll - event.y, max(0, max_items - 20)))
-                except:
-                    pass
-
-        pygame.display.flip()
+                scroll_file_browser(-event.y)
+
+            elif event.type == pygame.MOUSEWHEEL and generated_audio is not None and waveform_rect().collidepoint(
+                    pygame.mouse.get_pos()):
+                # wheel zooms around the mouse, a horizontal wheel scrolls
+                if event.y:
+                    zoom_waveform(event.y, pygame.mouse.get_pos()[0])
+                if event.x:
+                    spp = waveform_samples_per_pixel()
+                    set_waveform_view(waveform_start + event.x * waveform_rect().width * spp / 8, spp)
+
+            elif event.type == pygame.MOUSEWHEEL and grid_area_rect().collidepoint(pygame.mouse.get_pos()):
+                set_grid_scroll(grid_scroll + (event.x - event.y) * 4)
+
+        present_frame()
+        # the audio loop keeps time on its own, so the UI only needs to redraw at the frame cap
+        clock.tick(FPS)
     pygame.quit()
 
 
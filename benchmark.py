@@ -0,0 +1,258 @@
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from mido import Message, MetaMessage, MidiFile, MidiTrack, bpm2tempo
+
+from blackboard import parse_midi_table, parse_midi_table_mido, generate_audio, render_preview
+from console_channels import render_channels
+
+DEFAULT_THRESHOLD = 0.15
+# wall-time differences below this are timer noise, whatever the ratio
+TIME_SLACK_SECONDS = 0.02
+
+
+def write_stress_files(directory, scale=1.0):
+    '''
+    Synthetic MIDI files that stress one part of the converter each
+
+    - many_notes: a long run of short notes (note count)
+    - polyphony: wide chords on several channels (overlapping notes)
+    - tempo_changes: a tempo change before every note (tick-to-second conversion)
+
+    :param scale: multiplies the size of every file
+    :return: list of paths
+    '''
+    paths = []
+
+    def save(name, tracks):
+        mid = MidiFile(ticks_per_beat=480)
+        mid.tracks.extend(tracks)
+        path = os.path.join(directory, f"{name}.mid")
+        mid.save(path)
+        paths.append(path)
+
+    track = MidiTrack()
+    for i in range(int(40000 * scale)):
+        note = 36 + (i * 7) % 60
+        track.append(Message('note_on', note=note, velocity=90, time=0))
+        track.append(Message('note_off', note=note, velocity=0, time=60))
+    save("stress_many_notes", [track])
+
+    tracks = []
+    for channel in range(8):
+        track = MidiTrack()
+        for i in range(int(400 * scale)):
+            chord = [24 + channel * 8 + (i + k * 3) % 24 for k in range(8)]
+            for k, note in enumerate(chord):
+                track.append(Message('note_on', channel=channel, note=note, velocity=80, time=0))
+            for k, note in enumerate(chord):
+                track.append(Message('note_off', channel=channel, note=note, velocity=0, time=480 if k == 0 else 0))
+        tracks.append(track)
+    save("stress_polyphony", tracks)
+
+    tempo_track = MidiTrack()
+    notes_track = MidiTrack()
+    for i in range(int(10000 * scale)):
+        tempo_track.append(MetaMessage('set_tempo', tempo=bpm2tempo(60 + (i * 13) % 180), time=0 if i == 0 else 120))
+        notes_track.append(Message('note_on', note=60 + i % 12, velocity=100, time=0))
+        notes_track.append(Message('note_off', note=60 + i % 12, velocity=0, time=120))
+    save("stress_tempo_changes", [tempo_track, notes_track])
+    return paths
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def traced_peak(func, *args, **kwargs):
+    '''
+    Peak bytes allocated while func runs; kept out of the timed runs since tracing slows them down
+    '''
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def preview_head(notes):
+    # what render_preview has to do before the song can start playing
+    return next(render_preview(notes))
+
+
+def bench_file(path, repeat=3, render_params=None, render=generate_audio, preview=False):
+    '''
+    Time parse_midi_table and render (generate_audio or render_channels) on one file;
+    the best of `repeat` runs is kept
+
+    :param preview: also time render_preview up to its first playable segment (time to audible)
+    '''
+    render_params = render_params or {}
+    sample_rate = render_params.get("sample_rate", 44100)
+    parse_times = []
+    for _ in range(repeat):
+        notes, elapsed = timed(parse_midi_table, path)
+        parse_times.append(elapsed)
+    render_times = []
+    for _ in range(repeat):
+        audio, elapsed = timed(render, notes, **render_params)
+        render_times.append(elapsed)
+    audio_seconds = len(audio) / sample_rate
+    del audio
+
+    def stage(times, peak):
+        wall = min(times)
+        return {
+            "wall_time": wall,
+            "notes_per_second": len(notes) / wall if wall > 0 else None,
+            "realtime_factor": audio_seconds / wall if wall > 0 else None,
+            "peak_memory_bytes": peak,
+        }
+
+    result = {
+        "notes": len(notes),
+        "audio_seconds": audio_seconds,
+        "parse": stage(parse_times, traced_peak(parse_midi_table, path)),
+        "render": stage(render_times, traced_peak(render, notes, **render_params)),
+    }
+    if preview:
+        preview_times = [timed(preview_head, notes)[1] for _ in range(repeat)]
+        result["preview"] = stage(preview_times, traced_peak(preview_head, notes))
+    return result
+
+
+def verify_parsers(paths):
+    '''
+    Check parse_midi_table against the mido-based parse_midi_table_mido, the reference it must match
+
+    :return: list of human readable mismatch lines (empty when every table is byte-identical)
+    '''
+    mismatches = []
+    for path in paths:
+        name = os.path.basename(path)
+        table, reference = parse_midi_table(path), parse_midi_table_mido(path)
+        if len(table) != len(reference):
+            mismatches.append(f"{name}: {len(table)} notes, mido reference has {len(reference)}")
+        elif table.data.tobytes() != reference.data.tobytes():
+            for field in table.data.dtype.names:
+                differs = np.flatnonzero(table.data[field] != reference.data[field])
+                if len(differs):
+                    mismatches.append(f"{name}: {field} differs in {len(differs)} notes, first at note {differs[0]}")
+        print(f"verified {name} ({len(table)} notes)", flush=True)
+    return mismatches
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    '''
+    Wall-time and memory regressions of results against a baseline run
+
+    :return: list of human readable regression lines (empty when nothing regressed)
+    '''
+    regressions = []
+    for name, current in results["files"].items():
+        previous = baseline.get("files", {}).get(name)
+        if previous is None:
+            continue
+        for stage in ("parse", "render", "preview"):
+            if stage not in current or stage not in previous:
+                continue
+            for metric in ("wall_time", "peak_memory_bytes"):
+                old, new = previous[stage][metric], current[stage][metric]
+                slack = TIME_SLACK_SECONDS if metric == "wall_time" else 0
+                if old and new > old * (1 + threshold) + slack:
+                    regressions.append(f"{name} {stage} {metric}: {old:.4g} -> {new:.4g} (+{(new / old - 1) * 100:.0f}%)")
+    return regressions
+
+
+def print_table(results):
+    print(f"{'file':40} {'notes':>7} {'parse s':>8} {'render s':>9} {'notes/s':>9} {'x rt':>7} {'render MB':>10}"
+          f" {'preview s':>10}")
+    for name, r in results["files"].items():
+        render = r["render"]
+        preview = f"{r['preview']['wall_time']:10.3f}" if "preview" in r else f"{'-':>10}"
+        print(f"{name[:40]:40} {r['notes']:7d} {r['parse']['wall_time']:8.3f} {render['wall_time']:9.3f} "
+              f"{render['notes_per_second'] or 0:9.0f} {render['realtime_factor'] or 0:7.1f} "
+              f"{render['peak_memory_bytes'] / 2 ** 20:10.1f} {preview}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark parse_midi_table and generate_audio")
+    parser.add_argument("--dataset", default="dataset", help="directory of .mid files to benchmark")
+    parser.add_argument("--no-stress", action="store_true", help="skip the synthetic stress files")
+    parser.add_argument("--scale", type=float, default=1.0, help="size multiplier of the stress files")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, the fastest is reported")
+    parser.add_argument("--engine", choices=["notes", "channels"], default="notes",
+                        help="generate_audio, or render_channels (console voices)")
+    parser.add_argument("--oscillator", choices=["signal", "wavetable"], default="signal")
+    parser.add_argument("--dtype", default="float64")
+    parser.add_argument("--preview", action="store_true",
+                        help="also time render_preview up to its first segment (time until something can play)")
+    parser.add_argument("--verify", action="store_true",
+                        help="only check that parse_midi_table matches the mido reference parser on every file")
+    parser.add_argument("-o", "--output", default="bench_results.json", help="where to write the JSON results")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="relative slowdown / memory growth counted as a regression")
+    args = parser.parse_args(argv)
+
+    if args.engine == "channels":
+        render, render_params = render_channels, {"dtype": args.dtype}
+    else:
+        render, render_params = generate_audio, {"oscillator": args.oscillator, "dtype": args.dtype}
+    paths = sorted(os.path.join(args.dataset, name) for name in os.listdir(args.dataset)
+                   if name.lower().endswith(".mid"))
+
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "engine": args.engine,
+        "params": render_params,
+        "files": {},
+    }
+    with tempfile.TemporaryDirectory() as stress_dir:
+        if not args.no_stress:
+            paths += write_stress_files(stress_dir, args.scale)
+        if args.verify:
+            mismatches = verify_parsers(paths)
+            for line in mismatches:
+                print("MISMATCH", line)
+            if mismatches:
+                return 1
+            print(f"parse_midi_table matches parse_midi_table_mido on {len(paths)} files")
+            return 0
+        for path in paths:
+            name = os.path.basename(path)
+            results["files"][name] = bench_file(path, args.repeat, render_params, render, args.preview)
+            print(f"done {name}", flush=True)
+
+    print_table(results)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for line in regressions:
+            print("REGRESSION", line)
+        if regressions:
+            return 1
+        print(f"No regressions over {args.threshold * 100:.0f}% against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,38 +1,495 @@
-import mido
-from mido import MidiFile
-import sounddevice as sd
+import contextlib
+import functools
+import heapq
+import json
+import multiprocessing
+import struct
+import time
+from multiprocessing import shared_memory
+
 import numpy as np
-from scipy import signal
-from scipy.signal import butter, lfilter
 
-def parse_midi(file_path):
+# mido and scipy are imported where they are used, so importing this module stays cheap
+# (scipy.signal alone takes about a second)
+
+WAVETABLE_SIZE = 4096
+# frequency of every MIDI pitch, so oscillators look it up instead of recomputing it per note
+PITCH_FREQUENCIES = 440 * 2 ** ((np.arange(128) - 69) / 12)
+
+NOISE_BANK_SIZE = 2 ** 17
+NOISE_CUTOFF = 3000
+# whole envelopes are memoized only for notes too short to sustain (74 kB each at most with the default ADSR)
+ENVELOPE_CACHE_SIZE = 256
+# level of each oscillator layer in the mix; the noise level is the noise_ratio argument
+DEFAULT_WAVE_RATIOS = {'square': 0.75, 'triangle': 0.3}
+STEM_LAYERS = ('square', 'triangle', 'noise')
+# samples summed per step of mix_stems
+MIX_CHUNK = 1 << 15
+# audio render_preview has ready before it first yields, enough to start playback
+PREVIEW_SECONDS = 2.0
+# peak of the default mix is about this times the square root of the most notes sounding at once
+PREVIEW_VOICE_PEAK = 1.25
+# notes rendered between two progress callbacks
+PROGRESS_INTERVAL = 64
+
+_wavetables = {}
+_noise_banks = {}
+
+
+def get_wavetables(size=WAVETABLE_SIZE):
     '''
-    Parse MIDI file
+    Single-cycle tables for the wavetable oscillator, built once per size
+
+    :param size: samples per cycle, must be a power of two
+    :return: dict waveform name -> table, same shapes as signal.square / signal.sawtooth
+    '''
+    if size not in _wavetables:
+        from scipy import signal
+        phase = 2 * np.pi * np.arange(size) / size
+        _wavetables[size] = {
+            'square': signal.square(phase, duty=0.5),
+            'triangle': signal.sawtooth(phase, 0.5),
+        }
+    return _wavetables[size]
+
+
+def get_noise_bank(sample_rate=44100, seed=0, size=NOISE_BANK_SIZE, cutoff=NOISE_CUTOFF):
+    '''
+    Low-passed noise shared by every note, generated and filtered once
+
+    :param seed: seed of the Gaussian noise, None draws a fresh bank
+    :return: float64 array of `size` samples, read-only
+    '''
+    key = (sample_rate, seed, size, cutoff)
+    if seed is None or key not in _noise_banks:
+        from scipy.signal import butter, sosfilt
+        sos = butter(4, cutoff / (0.5 * sample_rate), btype='low', output='sos')
+        rng = np.random.default_rng(seed)
+        bank = sosfilt(sos, rng.normal(0, 0.3, size)) * 0.5
+        bank.setflags(write=False)
+        if seed is None:
+            return bank
+        _noise_banks[key] = bank
+    return _noise_banks[key]
+
+
+def noise_slice(bank, start_sample, pitch, total_samples):
+    '''
+    Noise for one note; the offset depends only on the note, so any render order gives the same audio
+    '''
+    size = len(bank)
+    offset = (start_sample * 7919 + int(pitch) * 104729) % size
+    if offset + total_samples <= size:
+        return bank[offset:offset + total_samples]
+    return np.take(bank, np.arange(offset, offset + total_samples), mode='wrap')
+
+
+def pitch_to_freq(pitch):
+    if 0 <= pitch < len(PITCH_FREQUENCIES):
+        return PITCH_FREQUENCIES[int(pitch)]
+    return 440 * 2 ** ((pitch - 69) / 12)
+
+
+def wavetable_oscillator(table, freq, total_samples, sample_rate, phase=0.0, out=None):
+    '''
+    Read a single-cycle table with a phase accumulator
+
+    :param table: one cycle, length must be a power of two
+    :param freq: oscillator frequency in Hz
+    :param total_samples: number of samples to produce
+    :param phase: start phase in cycles (0.0-1.0), so consecutive calls stay continuous
+    :param out: optional buffer of total_samples to write into, same dtype as table
+    :return: (samples, phase after the last sample)
+    '''
+    size = len(table)
+    step = freq / sample_rate
+    phases = np.arange(total_samples) * step
+    phases += phase
+    phases *= size
+    index = phases.astype(np.int64)
+    index &= size - 1
+    return np.take(table, index, out=out), (phase + total_samples * step) % 1.0
+
+class ConversionStats:
+    """
+    Opt-in instrumentation of one conversion
+
+    Pass an instance as stats= to parse_midi_table / generate_audio to
+    collect per-stage seconds, counters (notes, samples, allocations) and
+    the peak size of each buffer. Without it nothing is measured.
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+        self.peak_buffers = {}
+
+    def add_time(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def lap(self):
+        '''
+        Stopwatch for code split into consecutive stages: each call books the time since the previous one
+        '''
+        last = [time.perf_counter()]
+
+        def record(name):
+            now = time.perf_counter()
+            self.add_time(name, now - last[0])
+            last[0] = now
+
+        return record
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def buffer(self, name, nbytes):
+        self.peak_buffers[name] = max(self.peak_buffers.get(name, 0), int(nbytes))
+
+    def merge(self, other):
+        for name, seconds in other.timings.items():
+            self.add_time(name, seconds)
+        for name, n in other.counters.items():
+            self.count(name, n)
+        for name, nbytes in other.peak_buffers.items():
+            self.buffer(name, nbytes)
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.timings = dict(data.get('timings', {}))
+        stats.counters = dict(data.get('counters', {}))
+        stats.peak_buffers = dict(data.get('peak_buffers', {}))
+        return stats
+
+    def to_dict(self):
+        return {'timings': dict(self.timings), 'counters': dict(self.counters),
+                'peak_buffers': dict(self.peak_buffers)}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def summary(self):
+        '''
+        One line for a status bar: the slowest stages first
+        '''
+        stages = sorted(self.timings.items(), key=lambda item: -item[1])
+        parts = [f"{name} {seconds * 1000:.0f}ms" for name, seconds in stages[:5]]
+        if 'notes' in self.counters:
+            parts.append(f"{self.counters['notes']} notes")
+        return " | ".join(parts)
+
+
+def _no_lap(name):
+    pass
+
+
+NOTE_DTYPE = np.dtype([
+    ('start', np.float64),
+    ('duration', np.float64),
+    ('pitch', np.int16),
+    ('velocity', np.uint8),
+    ('channel', np.uint8),
+    ('track', np.uint16),
+])
+
+
+class NoteTable:
+    """
+    Columnar note list: one NumPy structured array sorted by start time
+
+    Iterating yields (start_time, duration, pitch) tuples, so it can be used
+    anywhere the list returned by parse_midi is accepted; the columns
+    (start, duration, pitch, velocity, channel, track) are plain arrays for
+    vectorized code.
+    """
+
+    def __init__(self, data=None):
+        self.data = np.zeros(0, dtype=NOTE_DTYPE) if data is None else np.asarray(data, dtype=NOTE_DTYPE)
+
+    @classmethod
+    def from_notes(cls, notes):
+        data = np.zeros(len(notes), dtype=NOTE_DTYPE)
+        if len(notes):
+            columns = list(zip(*notes))
+            data['start'], data['duration'], data['pitch'] = columns[:3]
+        return cls(data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return zip(self.data['start'].tolist(), self.data['duration'].tolist(), self.data['pitch'].tolist())
+
+    def __getitem__(self, index):
+        if isinstance(index, str):
+            return self.data[index]
+        if isinstance(index, (int, np.integer)):
+            row = self.data[index]
+            return float(row['start']), float(row['duration']), int(row['pitch'])
+        return NoteTable(self.data[index])
+
+    def __repr__(self):
+        return f"NoteTable({len(self)} notes)"
+
+    start = property(lambda self: self.data['start'])
+    duration = property(lambda self: self.data['duration'])
+    pitch = property(lambda self: self.data['pitch'])
+    velocity = property(lambda self: self.data['velocity'])
+    channel = property(lambda self: self.data['channel'])
+    track = property(lambda self: self.data['track'])
+
+    @property
+    def end_time(self):
+        return float(np.max(self.data['start'] + self.data['duration'])) if len(self) else 0.0
+
+    def to_list(self):
+        return list(self)
+
+
+def _track_events(track, track_index):
+    abs_time = 0
+    for msg in track:
+        abs_time += msg.time
+        yield abs_time, track_index, msg
+
+
+# data bytes after the status byte, by status for system messages and by high nibble for channel messages
+_SMF_DATA_LENGTHS = {0x80: 2, 0x90: 2, 0xA0: 2, 0xB0: 2, 0xC0: 1, 0xD0: 1, 0xE0: 2,
+                     0xF1: 1, 0xF2: 2, 0xF3: 1, 0xF6: 0, 0xF8: 0, 0xFA: 0, 0xFB: 0, 0xFC: 0, 0xFE: 0}
+
+
+def _scan_track(data, pos, end, track_index, event_ticks, notes, tempos):
+    '''
+    Walk one MTrk chunk without building messages, reading the same bytes mido would
+
+    Every tick an event falls on is appended to event_ticks (once per run of
+    events at that tick), note-ons and note-offs to notes packed into one int
+    as tick << 22 | status << 14 | note << 7 | velocity, and tempo changes
+    to tempos as (tick, track, tempo).
+    '''
+    tick = 0
+    status = None
+    lengths = _SMF_DATA_LENGTHS
+    add_tick, add_note = event_ticks.append, notes.append
+    while pos < end:
+        delta = data[pos]
+        pos += 1
+        if delta > 0x7F:
+            delta, pos = _read_varlen(data, pos - 1)
+        if delta:
+            tick += delta
+            add_tick(tick)
+
+        kind = data[pos]
+        if kind > 0x7F:
+            pos += 1
+            if kind != 0xFF:
+                status = kind
+            running = 0
+        elif status is None:
+            raise OSError('running status without last_status')
+        else:
+            # running status: the byte is the first data byte of a message like the last one
+            kind = status
+            running = 1
+
+        if kind < 0xA0:
+            note, velocity = data[pos], data[pos + 1]
+            if (note | velocity) > 0x7F:
+                raise OSError(f'data byte must be in range 0..127 at offset {pos}')
+            add_note((tick << 22) | (kind << 14) | (note << 7) | velocity)
+            pos += 2
+        elif kind == 0xFF:
+            meta = data[pos]
+            length, pos = _read_varlen(data, pos + 1)
+            if meta == 0x51 and length >= 3:
+                tempos.append((tick, track_index, (data[pos] << 16) | (data[pos + 1] << 8) | data[pos + 2]))
+            pos += length
+        elif kind == 0xF0 or kind == 0xF7:
+            # mido drops the byte it took for running status before a sysex
+            length, pos = _read_varlen(data, pos + running)
+            pos += length
+        else:
+            size = lengths.get(kind if kind >= 0xF0 else kind & 0xF0)
+            if size is None:
+                raise OSError(f'undefined status byte 0x{kind:02x}')
+            pos += size
+    if pos != end:
+        raise OSError('track runs past the end of its chunk')
+
+
+def _read_varlen(data, pos):
+    byte = data[pos]
+    pos += 1
+    value = byte & 0x7F
+    while byte & 0x80:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+    return value, pos
+
+
+def decode_smf(data):
+    '''
+    Read the header and scan every track of a Standard MIDI File
+
+    Only the bytes of note-on, note-off and set_tempo events are decoded;
+    everything else is skipped by its length.
+
+    :param data: contents of a .mid file
+    :return: (ticks_per_beat, ticks of all events, notes, notes per track, tempos); see _scan_track
+    '''
+    if len(data) < 14 or data[:4] != b'MThd':
+        raise OSError('MThd not found. Probably not a MIDI file')
+    header_size = int.from_bytes(data[4:8], 'big')
+    _, track_count, ticks_per_beat = struct.unpack('>hhh', data[8:14])
+    pos = 8 + header_size
+    event_ticks, notes, track_notes, tempos = [0], [], [], []
+    for track_index in range(track_count):
+        if len(data) < pos + 8:
+            raise EOFError
+        name, size = data[pos:pos + 4], int.from_bytes(data[pos + 4:pos + 8], 'big')
+        if name != b'MTrk':
+            raise OSError('no MTrk header at start of track')
+        try:
+            _scan_track(data, pos + 8, pos + 8 + size, track_index, event_ticks, notes, tempos)
+        except IndexError:
+            raise EOFError from None
+        track_notes.append(len(notes) - sum(track_notes))
+        pos += 8 + size
+    return ticks_per_beat, event_ticks, notes, track_notes, tempos
+
+
+def tick_seconds(ticks, tempos, ticks_per_beat, tempo=500000):
+    '''
+    Time in seconds of every distinct event tick, from a precomputed tempo map
+
+    The time is the running sum over the gaps between consecutive event
+    ticks, each gap at the tempo in force where it starts, which adds up the
+    same float64 values in the same order as converting event by event with
+    mido.tick2second, so the seconds come out identical.
+
+    :param ticks: ticks of all events, any order, duplicates allowed
+    :param tempos: (tick, track, tempo) set_tempo events in merged order
+    :return: (sorted distinct ticks, seconds at each)
+    '''
+    ticks = np.unique(np.asarray(ticks, dtype=np.int64))
+    gaps = np.diff(ticks)
+    if tempos:
+        tempo_ticks = np.array([t[0] for t in tempos], dtype=np.int64)
+        tempo_map = np.array([tempo] + [t[2] for t in tempos], dtype=np.int64)
+        # the last change at or before the tick a gap starts from; index 0 is the default tempo
+        in_force = tempo_map[np.searchsorted(tempo_ticks, ticks[:-1], side='right')]
+    else:
+        in_force = np.full(len(gaps), tempo, dtype=np.int64)
+    seconds = np.zeros(len(ticks))
+    np.cumsum(gaps * (in_force * 1e-6 / ticks_per_beat), out=seconds[1:])
+    return ticks, seconds
+
+
+def parse_midi_table(file_path, stats=None):
+    '''
+    Parse MIDI file into a NoteTable
+
+    The track bytes are scanned directly (decode_smf) instead of through
+    mido, which builds a Message object for every event. Note events are
+    then paired in the order a k-way merge of the tracks by tick would give,
+    and their seconds looked up from tick_seconds, so the table matches
+    parse_midi_table_mido exactly.
 
     :param file_path:
-    :return: list containing MIDI information (start_time, duration, pitch)
+    :param stats: optional ConversionStats
+    :return: NoteTable with start, duration, pitch, velocity, channel and track per note
+    '''
+    lap = stats.lap() if stats is not None else _no_lap
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    lap('midi_io')
+
+    ticks_per_beat, event_ticks, packed, track_notes, tempos = decode_smf(data)
+    events = np.array(packed, dtype=np.int64)
+    event_tracks = np.repeat(np.arange(len(track_notes)), track_notes)
+    # a stable sort by tick keeps equal ticks in track order, like the merge in parse_midi_table_mido
+    order = np.argsort(events >> 22, kind='stable')
+    events, event_tracks = events[order], event_tracks[order]
+    tempos.sort(key=lambda x: x[0])
+    if stats is not None:
+        stats.count('events', len(events))
+    lap('smf_scan')
+
+    ticks, seconds = tick_seconds(event_ticks, tempos, ticks_per_beat)
+    times = seconds[np.searchsorted(ticks, events >> 22)]
+    lap('tick_conversion')
+
+    status, velocity = (events >> 14) & 0xFF, events & 0x7F
+    on = ((status & 0xF0) == 0x90) & (velocity > 0)
+    key = (events >> 7) & 0x7FF  # channel and note
+    # per key an off closes a note exactly when the event before it was an on, which
+    # is when the dict of pending notes in parse_midi_table_mido holds that key
+    by_key = np.argsort(key, kind='stable')
+    closes = np.nonzero((key[by_key[1:]] == key[by_key[:-1]]) & on[by_key[:-1]] & ~on[by_key[1:]])[0]
+    ends = by_key[closes + 1]
+    emitted = np.argsort(ends, kind='stable')
+    ends, begins = ends[emitted], by_key[closes][emitted]
+
+    data = np.zeros(len(ends), dtype=NOTE_DTYPE)
+    data['start'] = times[begins]
+    data['duration'] = times[ends] - times[begins]
+    data['pitch'] = (events[ends] >> 7) & 0x7F
+    data['velocity'] = velocity[begins]
+    data['channel'] = status[ends] & 0x0F
+    data['track'] = event_tracks[begins]
+    notes = NoteTable(data[np.argsort(data['start'], kind='stable')])
+    lap('note_table')
+    if stats is not None:
+        stats.count('notes', len(notes))
+        stats.buffer('note_table', notes.data.nbytes)
+    return notes
+
+
+def parse_midi_table_mido(file_path, stats=None):
+    '''
+    Parse MIDI file into a NoteTable through mido, the reference for parse_midi_table
+
+    The tracks are already in time order, so they are k-way merged rather
+    than concatenated and sorted.
+
+    :param file_path:
+    :param stats: optional ConversionStats
+    :return: NoteTable with start, duration, pitch, velocity, channel and track per note
     '''
-    mid = MidiFile(file_path)
+    import mido
+    lap = stats.lap() if stats is not None else _no_lap
+    mid = mido.MidiFile(file_path)
     ticks_per_beat = mid.ticks_per_beat
     tempo = 500000
+    lap('midi_io')
 
-    events = []
-    for track in mid.tracks:
-        abs_time = 0
-        for msg in track:
-            abs_time += msg.time
-            events.append((abs_time, msg))
-
-    # sort the event by absolute time line
-    events.sort(key=lambda x: x[0])
+    # heapq.merge keeps equal times in track order, like the stable sort it replaces
+    events = heapq.merge(*(_track_events(track, i) for i, track in enumerate(mid.tracks)),
+                         key=lambda x: x[0])
+    if stats is not None:
+        # materialized only when measured, so merging and conversion are timed apart
+        events = list(events)
+        stats.count('events', len(events))
+        lap('event_merge')
 
     current_time = 0.0
     current_tempo = tempo
     prev_abs_ticks = 0
     active_notes = {}
-    notes = []
+    starts, durations, pitches, velocities, channels, tracks = [], [], [], [], [], []
 
-    for abs_ticks, msg in events:
+    for abs_ticks, track_index, msg in events:
         delta_ticks = abs_ticks - prev_abs_ticks
         prev_abs_ticks = abs_ticks
         delta_seconds = mido.tick2second(delta_ticks, ticks_per_beat, current_tempo)
@@ -42,114 +499,704 @@ def parse_midi(file_path):
             current_tempo = msg.tempo
         elif msg.type == 'note_on' and msg.velocity > 0:
             key = (msg.channel, msg.note)
-            active_notes[key] = current_time
+            active_notes[key] = (current_time, msg.velocity, track_index)
         elif msg.type in ['note_off', 'note_on'] and (msg.velocity == 0 or msg.type == 'note_off'):
             key = (msg.channel, msg.note)
             if key in active_notes:
-                start = active_notes.pop(key)
-                notes.append((start, current_time - start, msg.note))
+                start, velocity, start_track = active_notes.pop(key)
+                starts.append(start)
+                durations.append(current_time - start)
+                pitches.append(msg.note)
+                velocities.append(velocity)
+                channels.append(msg.channel)
+                tracks.append(start_track)
+
+    lap('tick_conversion')
+
+    data = np.zeros(len(starts), dtype=NOTE_DTYPE)
+    data['start'] = starts
+    data['duration'] = durations
+    data['pitch'] = pitches
+    data['velocity'] = velocities
+    data['channel'] = channels
+    data['track'] = tracks
+    notes = NoteTable(data[np.argsort(data['start'], kind='stable')])
+    lap('note_table')
+    if stats is not None:
+        stats.count('notes', len(notes))
+        stats.buffer('note_table', notes.data.nbytes)
+    return notes
+
+
+def parse_midi(file_path):
+    '''
+    Parse MIDI file
+
+    :param file_path:
+    :return: list containing MIDI information (start_time, duration, pitch)
+    '''
+    return parse_midi_table(file_path).to_list()
+
+
+def note_columns(notes):
+    '''
+    Start, duration and pitch arrays of a NoteTable or a (start, duration, pitch) list
+    '''
+    if isinstance(notes, NoteTable):
+        return notes.start, notes.duration, notes.pitch
+    columns = np.array(notes, dtype=np.float64).reshape(-1, 3)
+    return columns[:, 0], columns[:, 1], columns[:, 2].astype(np.int64)
+
+
+def note_spans(notes, sample_rate=44100):
+    '''
+    Vectorized sample positions of every note, same rounding as the per-note code
 
-    return sorted(notes, key=lambda x: x[0])
+    :return: (start_samples, total_samples, durations, pitches) arrays
+    '''
+    starts, durations, pitches = note_columns(notes)
+    start_samples = (starts * sample_rate).astype(np.int64)
+    end_samples = ((starts + durations) * sample_rate).astype(np.int64)
+    return start_samples, end_samples - start_samples, durations, pitches
+
+
+def _adsr_samples(total_samples, adsr_params, sample_rate):
+    attack_time, decay_time, _, release_time = adsr_params
+    attack_samples = min(int(attack_time * sample_rate), total_samples)
+    decay_samples = min(int(decay_time * sample_rate), total_samples - attack_samples)
+    release_samples = min(int(release_time * sample_rate), total_samples)
+    return attack_samples, decay_samples, release_samples
+
+
+@functools.lru_cache(maxsize=ENVELOPE_CACHE_SIZE)
+def _cached_envelope(total_samples, adsr_params, sample_rate):
+    sustain_level = adsr_params[2]
+    attack_samples, decay_samples, release_samples = _adsr_samples(total_samples, adsr_params, sample_rate)
+    envelope = np.ones(total_samples)
+    sustain_samples = max(0, total_samples - attack_samples - decay_samples - release_samples)
+    if attack_samples > 0:
+        envelope[:attack_samples] = np.linspace(0, 1, attack_samples)
+    if decay_samples > 0:
+        decay_start = attack_samples
+        decay_end = decay_start + decay_samples
+        envelope[decay_start:decay_end] = np.linspace(1, sustain_level, decay_samples)
+    if sustain_samples > 0:
+        sustain_start = attack_samples + decay_samples
+        envelope[sustain_start:-release_samples] = sustain_level
+    if release_samples > 0:
+        release_start = max(0, total_samples - release_samples)
+        env_slice = envelope[release_start:]
+        env_slice *= np.linspace(1, 0, release_samples)
+    envelope.setflags(write=False)
+    return envelope
+
+
+@functools.lru_cache(maxsize=16)
+def _envelope_ends(adsr_params, sample_rate):
+    # attack + decay head and release tail of every note long enough to reach the sustain
+    attack_time, decay_time, sustain_level, release_time = adsr_params
+    head = np.concatenate([np.linspace(0, 1, int(attack_time * sample_rate)),
+                           np.linspace(1, sustain_level, int(decay_time * sample_rate))])
+    tail = np.linspace(1, 0, int(release_time * sample_rate))
+    head.setflags(write=False)
+    tail.setflags(write=False)
+    return head, tail
+
+
+def apply_adsr(buffer, adsr_params=(0.01, 0.1, 0.7, 0.1), sample_rate=44100):
+    '''
+    Multiply one note by its ADSR envelope in place
+
+    Only the attack/decay head and the release tail are memoized, per
+    (adsr_params, sample_rate); the sustain is a constant multiply on the
+    middle slice, so long notes cost no cache memory. Short notes, whose
+    ramps are cut by their length, use a whole memoized envelope. The result
+    is identical to multiplying by adsr_envelope().
+
+    :param adsr_params: (attack_time, decay_time, sustain_level, release_time)
+    :return: buffer
+    '''
+    adsr_params = tuple(adsr_params)
+    total = len(buffer)
+    head, tail = _envelope_ends(adsr_params, sample_rate)
+    if total <= len(head) + len(tail):
+        buffer *= _cached_envelope(total, adsr_params, sample_rate)
+        return buffer
+    buffer[:len(head)] *= head
+    # like envelope[sustain_start:-release_samples], nothing is sustained when there is no release
+    if len(tail):
+        # a float64 scalar, so float32 buffers are rounded like the float64 envelope product
+        buffer[len(head):total - len(tail)] *= np.float64(adsr_params[2])
+        buffer[total - len(tail):] *= tail
+    return buffer
+
+
+def adsr_envelope(total_samples, adsr_params=(0.01, 0.1, 0.7, 0.1), sample_rate=44100):
+    '''
+    ADSR envelope of one note
+
+    :param adsr_params: (attack_time, decay_time, sustain_level, release_time)
+    :return: float64 array of total_samples
+    '''
+    return apply_adsr(np.ones(int(total_samples)), adsr_params, sample_rate)
+
+
+def make_note_renderer(sample_rate=44100, noise_ratio=0.1,
+                       adsr_params=(0.01, 0.1, 0.7, 0.1), oscillator='signal', noise_seed=0,
+                       dtype=np.float64, stats=None, wave_ratios=None):
+    """
+    Build the per-note synthesis shared by generate_audio and stream_audio
+
+    param：
+    - same synthesis parameters as generate_audio
+    - dtype: float dtype of the rendered notes
+    - stats: optional ConversionStats, gets oscillator / noise / envelope time
+    - wave_ratios: optional {'square': ..., 'triangle': ...} overriding DEFAULT_WAVE_RATIOS;
+      a layer at 0 is not synthesized at all
+
+    return：
+    render_note(dur, pitch, total_samples, start_sample, out=None) -> enveloped mix of one note,
+    written into out[:total_samples] when a scratch buffer is given
+    """
+    # mixed wave ratio, can modify it to simulate NES or other old game console
+    wave_ratios = {
+        **DEFAULT_WAVE_RATIOS,
+        **(wave_ratios or {}),
+        'noise': noise_ratio
+    }
+    tone = wave_ratios['square'] or wave_ratios['triangle']
+
+    if oscillator == 'wavetable':
+        tables = get_wavetables()
+        tone_table = 0.6 * (tables['square'] * wave_ratios['square'] +
+                            tables['triangle'] * wave_ratios['triangle'])
+        tone_table = tone_table.astype(dtype, copy=False)
+    elif oscillator == 'signal':
+        from scipy import signal
+    else:
+        raise ValueError(f"Unknown oscillator: {oscillator}")
+
+    # the noise channel is skipped entirely when it is muted
+    noise_bank = None
+    if noise_ratio:
+        noise_bank = (get_noise_bank(sample_rate, noise_seed) * wave_ratios['noise']).astype(dtype, copy=False)
+        if stats is not None:
+            stats.buffer('noise_bank', noise_bank.nbytes)
+
+    def render_note(dur, pitch, total_samples, start_sample=0, out=None):
+        lap = stats.lap() if stats is not None else _no_lap
+        freq = pitch_to_freq(pitch)
+        if out is None:
+            mixed = np.empty(total_samples, dtype=dtype)
+            if stats is not None:
+                stats.count('allocations')
+        else:
+            mixed = out[:total_samples]
+
+        # Control the ratio of different wave.
+        if not tone:
+            mixed.fill(0)
+        elif oscillator == 'wavetable':
+            wavetable_oscillator(tone_table, freq, total_samples, sample_rate, out=mixed)
+        else:
+            t = np.linspace(0, dur, total_samples, False)
+            layers = []
+            if wave_ratios['square']:
+                square = 0.6 * signal.square(2 * np.pi * freq * t, duty=0.5) #generate square wave
+                square *= wave_ratios['square']
+                layers.append(square)
+            if wave_ratios['triangle']:
+                triangle = 0.6 * signal.sawtooth(2 * np.pi * freq * t, 0.5) #generate triangle wave
+                triangle *= wave_ratios['triangle']
+                layers.append(triangle)
+            if len(layers) == 2:
+                np.add(*layers, out=mixed)
+            else:
+                mixed[:] = layers[0]
+        lap('oscillator')
+        if noise_bank is not None:
+            mixed += noise_slice(noise_bank, start_sample, pitch, total_samples)
+            lap('noise')
+
+        apply_adsr(mixed, adsr_params, sample_rate)
+        lap('envelope')
+        return mixed
+
+    return render_note
+
+
+def audio_length(notes, sample_rate=44100):
+    starts, durations, _ = note_columns(notes)
+    max_time = float(np.max(starts + durations))
+    return int(np.ceil(max_time * sample_rate)) + 1
+
+
+class ConversionCancelled(Exception):
+    """
+    Raised from a progress callback to abandon a conversion
+    """
+
+
+def mix_notes(buffer, segment_start, spans, render_note, stats=None, progress=None):
+    '''
+    Add the notes to a buffer holding samples [segment_start, segment_start + len(buffer))
+
+    Notes are clipped to the segment, so a note straddling two segments is
+    rendered by both and each adds its own part.
+
+    :param spans: (start_samples, total_samples, durations, pitches) as from note_spans
+    :param stats: optional ConversionStats, gets mixing time and note / sample counts
+    :param progress: optional callable(fraction done); it may raise ConversionCancelled
+    '''
+    segment_end = segment_start + len(buffer)
+    longest = int(spans[1].max()) if len(spans[1]) else 0
+    # one scratch buffer reused by every note instead of a fresh array per note
+    scratch = np.empty(max(longest, 0), dtype=buffer.dtype)
+    if stats is not None:
+        stats.count('allocations')
+        stats.buffer('scratch', scratch.nbytes)
+    note_count = len(spans[0])
+    for index, (start_sample, total_samples, dur, pitch) in enumerate(zip(*(column.tolist() for column in spans))):
+        if progress is not None and index % PROGRESS_INTERVAL == 0:
+            progress(index / note_count)
+        if total_samples <= 0:
+            continue
+        lo = max(start_sample, segment_start)
+        hi = min(start_sample + total_samples, segment_end)
+        if hi <= lo:
+            continue
+        mixed = render_note(dur, pitch, total_samples, start_sample, out=scratch)
+        if stats is None:
+            buffer[lo - segment_start:hi - segment_start] += mixed[lo - start_sample:hi - start_sample]
+            continue
+        with stats.stage('mixing'):
+            buffer[lo - segment_start:hi - segment_start] += mixed[lo - start_sample:hi - start_sample]
+        stats.count('rendered_notes')
+        stats.count('samples', hi - lo)
+    if progress is not None:
+        progress(1.0)
+
+
+def _render_segment(job):
+    # worker side of generate_audio(workers=...): attach to the shared output and mix one segment
+    shm_name, length, segment_start, segment_end, spans, params = job
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        audio = np.ndarray(length, dtype=params['dtype'], buffer=shm.buf)
+        render_note = make_note_renderer(**params)
+        mix_notes(audio[segment_start:segment_end], segment_start, spans, render_note)
+        del audio
+    finally:
+        shm.close()
+
+
+def _render_parallel(notes, length, workers, params, progress=None):
+    spans = note_spans(notes, params['sample_rate'])
+    start_samples, note_lengths = spans[0], spans[1]
+    # cut where the notes start so every segment has a similar amount of work
+    segments = workers * 4
+    bounds = np.quantile(start_samples, np.linspace(0, 1, segments + 1)[1:-1]).astype(np.int64)
+    bounds = np.unique(np.concatenate([[0], bounds, [length]]))
+    note_ends = start_samples + note_lengths
+
+    dtype = np.dtype(params['dtype'])
+    shm = shared_memory.SharedMemory(create=True, size=max(length, 1) * dtype.itemsize)
+    try:
+        audio = np.ndarray(length, dtype=dtype, buffer=shm.buf)
+        audio[:] = 0
+        jobs = []
+        for segment_start, segment_end in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            selected = np.nonzero((start_samples < segment_end) & (note_ends > segment_start))[0]
+            jobs.append((shm.name, length, segment_start, segment_end,
+                         tuple(column[selected] for column in spans), params))
+        with multiprocessing.Pool(processes=workers) as pool:
+            for done, _ in enumerate(pool.imap_unordered(_render_segment, jobs), 1):
+                if progress is not None:
+                    progress(done / len(jobs))
+        result = audio.copy()
+        del audio
+    finally:
+        shm.close()
+        shm.unlink()
+    return result
+
+
+def to_pcm16(audio):
+    '''
+    Convert float audio in [-1, 1] to int16 PCM in one pass, without a float temporary
+    '''
+    pcm = np.empty(len(audio), dtype=np.int16)
+    np.multiply(audio, 32767, out=pcm, casting='unsafe')
+    return pcm
+
+
+class GeneratedAudio:
+    """
+    Rendered song plus its int16 PCM and peak index, each built once and shared by playback, display and export
+    """
+
+    def __init__(self, samples, sample_rate=44100):
+        self.samples = samples
+        self.sample_rate = sample_rate
+        # samples final so far; less than the length only while render_preview is still filling it
+        self.ready = len(samples)
+        self._pcm = None
+        self._peaks = None
+
+    def __len__(self):
+        return len(self.samples)
+
+    @property
+    def duration(self):
+        return len(self.samples) / self.sample_rate
+
+    @property
+    def pcm(self):
+        if self._pcm is None:
+            self._pcm = self.samples if self.samples.dtype == np.int16 else to_pcm16(self.samples)
+        return self._pcm
+
+    @property
+    def peaks(self):
+        '''
+        waveform.PeakPyramid of the samples, built on first use
+        '''
+        if self._peaks is None:
+            from waveform import PeakPyramid
+            self._peaks = PeakPyramid.from_audio(self.samples)
+        return self._peaks
+
+    def rendered(self):
+        '''
+        The part rendered so far as a complete GeneratedAudio, for a preview whose render was abandoned
+        '''
+        if self.ready == len(self.samples):
+            return self
+        audio = GeneratedAudio(self.samples[:self.ready], self.sample_rate)
+        if self._pcm is not None:
+            audio._pcm = self._pcm[:self.ready]
+        if self._peaks is not None and not self._peaks.finished:
+            self._peaks.finish()
+        audio._peaks = self._peaks
+        return audio
+
+    def write(self, path):
+        import soundfile as sf
+        sf.write(path, self.pcm, samplerate=self.sample_rate, subtype='PCM_16')
 
 
 def generate_audio(notes, sample_rate=44100, noise_ratio=0.1,
-                   adsr_params=(0.01, 0.1, 0.7, 0.1)):
+                   adsr_params=(0.01, 0.1, 0.7, 0.1), oscillator='signal', noise_seed=0, workers=1,
+                   dtype=np.float64, stats=None, progress=None, wave_ratios=None):
     """
     Generate the mix wave including a symple ADSR and noise control
 
     param：
-    - notes: (start_time, duration, pitch)
+    - notes: NoteTable or list of (start_time, duration, pitch)
     - sample_rate: default 44100
     - noise_ratio:（0.0-1.0）
     - adsr_params: (attack_time, decay_time, sustain_level, release_time)
+    - oscillator: 'signal' computes scipy square/triangle per note,
+      'wavetable' reads one pre-mixed square+triangle cycle (much faster)
+    - noise_seed: seed of the shared noise bank, same seed gives the same audio
+    - workers: processes rendering time segments into shared memory;
+      the result is bit-identical to workers=1
+    - dtype: float64, float32 (mixes in place at half the memory) or int16
+      (mixed as float32, returned as PCM)
+    - stats: optional ConversionStats filled with per-stage timings and counters
+    - progress: optional callable(fraction done), called every few notes; raising
+      ConversionCancelled from it stops the render
+    - wave_ratios: optional {'square': ..., 'triangle': ...} levels, see DEFAULT_WAVE_RATIOS
 
     return：
     audio list
     """
+    dtype = np.dtype(dtype)
+    pcm = dtype == np.int16
+    mix_dtype = np.dtype(np.float32) if pcm else dtype
     if not notes:
-        return np.zeros(0)
+        return np.zeros(0, dtype=dtype)
 
-    max_time = max(start + dur for start, dur, _ in notes)
-    audio = np.zeros(int(np.ceil(max_time * sample_rate)) + 1)
+    length = audio_length(notes, sample_rate)
+    if stats is not None:
+        stats.buffer('output', length * mix_dtype.itemsize)
+    if workers > 1:
+        params = {'sample_rate': sample_rate, 'noise_ratio': noise_ratio, 'adsr_params': adsr_params,
+                  'oscillator': oscillator, 'noise_seed': noise_seed, 'dtype': mix_dtype, 'wave_ratios': wave_ratios}
+        with stats.stage('parallel_render') if stats is not None else contextlib.nullcontext():
+            audio = _render_parallel(notes, length, workers, params, progress)
+    else:
+        audio = np.zeros(length, dtype=mix_dtype)
+        render_note = make_note_renderer(sample_rate, noise_ratio, adsr_params, oscillator, noise_seed,
+                                         mix_dtype, stats, wave_ratios=wave_ratios)
+        mix_notes(audio, 0, note_spans(notes, sample_rate), render_note, stats, progress)
+    lap = stats.lap() if stats is not None else _no_lap
+    #     Lower the peak noise
+    peak = max(audio.max(), -audio.min())
+    if peak > 0:
+        audio /= peak * 1.4
+    lap('normalization')
 
-    attack_time, decay_time, sustain_level, release_time = adsr_params
+    if pcm:
+        audio = to_pcm16(audio)
+        lap('pcm_conversion')
+    return audio
 
-    # mixed wave ratio, can modify it to simulate NES or other old game console
-    wave_ratios = {
-        'square': 0.75,
-        'triangle': 0.3,
-        'noise': noise_ratio
-    }
 
+def render_stems(notes, sample_rate=44100, adsr_params=(0.01, 0.1, 0.7, 0.1), oscillator='signal', noise_seed=0,
+                 dtype=np.float32, stats=None, progress=None):
+    """
+    Render the square, triangle and noise layers of the song as separate stems
+
+    Every stem is the sum of one layer over all notes at level 1, with the
+    envelope applied. mix_stems turns them into the generate_audio result
+    for any ratios, so a new mix is one weighted sum instead of a re-render.
 
+    param：
+    - notes, sample_rate, adsr_params, oscillator, noise_seed, stats: as generate_audio
+    - dtype: float dtype of the stems
+    - progress: optional callable(fraction done) over the three layers
 
+    return：
+    array of shape (3, samples), rows in STEM_LAYERS order
+    """
+    dtype = np.dtype(dtype)
+    if not notes:
+        return np.zeros((len(STEM_LAYERS), 0), dtype=dtype)
+    stems = np.zeros((len(STEM_LAYERS), audio_length(notes, sample_rate)), dtype=dtype)
+    if stats is not None:
+        stats.buffer('stems', stems.nbytes)
+    spans = note_spans(notes, sample_rate)
+    for index, layer in enumerate(STEM_LAYERS):
+        wave_ratios = {name: float(name == layer) for name in DEFAULT_WAVE_RATIOS}
+        render_note = make_note_renderer(sample_rate, float(layer == 'noise'), adsr_params, oscillator, noise_seed,
+                                         dtype, stats, wave_ratios=wave_ratios)
+        layer_progress = None if progress is None else (
+            lambda fraction, index=index: progress((index + fraction) / len(STEM_LAYERS)))
+        mix_notes(stems[index], 0, spans, render_note, stats, layer_progress)
+    return stems
 
-    def lowpass_filter(data, cutoff=2000, order=4):
-        nyq = 0.5 * sample_rate
-        normal_cutoff = cutoff / nyq
-        b, a = butter(order, normal_cutoff, btype='low')
-        return lfilter(b, a, data)
 
-    for start, dur, pitch in notes:
-        freq = 440 * 2 ** ((pitch - 69) / 12)
-        start_sample = int(start * sample_rate)
-        end_sample = int((start + dur) * sample_rate)
-        total_samples = end_sample - start_sample
-        if total_samples <= 0:
-            continue
-        t = np.linspace(0, dur, total_samples, False)
-        square = 0.6 * signal.square(2 * np.pi * freq * t, duty=0.5) #generate square wave
-        triangle = 0.6 * signal.sawtooth(2 * np.pi * freq * t, 0.5) #generate triangle wave
-        noise = np.random.normal(0, 0.3, total_samples)
-        noise = lowpass_filter(noise, cutoff=3000) * 0.5
+def mix_stems(stems, wave_ratios=None, noise_ratio=0.1, dtype=None):
+    """
+    Weighted sum of render_stems output, normalized like generate_audio
 
-        # Control the ratio of different wave.
+    param：
+    - stems: (3, samples) array from render_stems, may be read-only / memory-mapped
+    - wave_ratios: {'square': ..., 'triangle': ...}, defaults to DEFAULT_WAVE_RATIOS
+    - noise_ratio: level of the noise stem
+    - dtype: output dtype, the stems' dtype by default; int16 returns PCM
 
-        mixed = (
-                square * wave_ratios['square'] +
-                triangle * wave_ratios['triangle'] +
-                noise * wave_ratios['noise']
-        )
-
-
-
-
-        envelope = np.ones(total_samples)
-        attack_samples = min(int(attack_time * sample_rate), total_samples)
-        remaining = total_samples - attack_samples
-        decay_samples = min(int(decay_time * sample_rate), remaining)
-        remaining -= decay_samples
-        release_samples = min(int(release_time * sample_rate), total_samples)
-        sustain_samples = max(0, total_samples - attack_samples - decay_samples - release_samples)
-        if attack_samples > 0:
-            envelope[:attack_samples] = np.linspace(0, 1, attack_samples)
-        if decay_samples > 0:
-            decay_start = attack_samples
-            decay_end = decay_start + decay_samples
-            envelope[decay_start:decay_end] = np.linspace(1, sustain_level, decay_samples)
-        if sustain_samples > 0:
-            sustain_start = attack_samples + decay_samples
-            envelope[sustain_start:-release_samples] = sustain_level
-        if release_samples > 0:
-            release_start = max(0, total_samples - release_samples)
-            env_slice = envelope[release_start:]
-            env_slice *= np.linspace(1, 0, release_samples)
-        mixed *= envelope
-        buffer_end = start_sample + total_samples
-        if buffer_end > len(audio):
-            mixed = mixed[:len(audio) - start_sample]
-            buffer_end = len(audio)
-        audio[start_sample:buffer_end] += mixed
-    #     Lower the peak noise
-    peak = np.max(np.abs(audio))
+    return：
+    audio array
+    """
+    ratios = [{**DEFAULT_WAVE_RATIOS, **(wave_ratios or {}), 'noise': noise_ratio}[layer] for layer in STEM_LAYERS]
+    dtype = np.dtype(dtype or stems.dtype)
+    mix_dtype = np.dtype(np.float32) if dtype == np.int16 else dtype
+    length = stems.shape[1]
+    audio = np.empty(length, dtype=mix_dtype)
+    scratch = np.empty(min(length, MIX_CHUNK), dtype=mix_dtype)
+    peak = 0.0
+    # summed in cache-sized chunks, and the peak is taken while each chunk is still hot
+    for start in range(0, length, MIX_CHUNK):
+        out = audio[start:start + MIX_CHUNK]
+        part = scratch[:len(out)]
+        out.fill(0)
+        for stem, ratio in zip(stems, ratios):
+            if ratio:
+                np.multiply(stem[start:start + MIX_CHUNK], ratio, out=part, casting='same_kind')
+                out += part
+        peak = max(peak, float(out.max()), -float(out.min()))
     if peak > 0:
         audio /= peak * 1.4
-
+    if dtype == np.int16:
+        return to_pcm16(audio)
     return audio
+
+
+def _max_polyphony(spans):
+    # most notes sounding at once; an end sorts before a start on the same sample
+    starts, lengths = spans[0], spans[1]
+    if not len(starts):
+        return 0
+    events = np.concatenate([starts, starts + lengths])
+    steps = np.concatenate([np.ones(len(starts), dtype=np.int64), -np.ones(len(starts), dtype=np.int64)])
+    order = np.lexsort((steps, events))
+    return int(np.cumsum(steps[order]).max())
+
+
+def render_preview(notes, sample_rate=44100, oscillator='wavetable', head_seconds=PREVIEW_SECONDS, stats=None,
+                   progress=None, **params):
+    """
+    Quick-listen render that can be played while the rest is still rendering
+
+    The cost of a render is per note rather than per sample, so the preview
+    is not made cheaper but playable sooner: notes are synthesized at full
+    rate in start order, first those starting in the first head_seconds,
+    then in segments of doubling length. Once every note starting before a
+    segment's end is mixed, the audio before it is final and is levelled,
+    converted to PCM and indexed for the waveform. The song's peak is not
+    known yet, so levelling estimates it from the polyphony (or the first
+    segment's peak, if higher) and limit_block holds louder passages under
+    the same ceiling; on dataset/ the levels land within about 20% of the
+    full render.
+
+    param：
+    - head_seconds: audio ready at the first yield (PREVIEW_SECONDS)
+    - params: other generate_audio arguments (noise_ratio, wave_ratios, ...)
+
+    return：
+    generator yielding the same GeneratedAudio after each segment, its
+    `ready` samples growing to the full audio_length(notes, sample_rate)
+    """
+    from waveform import PeakPyramid
+    length = audio_length(notes, sample_rate) if notes else 0
+    samples = np.zeros(length, dtype=np.float32)
+    audio = GeneratedAudio(samples, sample_rate)
+    audio.ready = 0
+    audio._pcm = np.zeros(length, dtype=np.int16)
+    audio._peaks = PeakPyramid(samples)
+    render_note = make_note_renderer(sample_rate, oscillator=oscillator, dtype=np.float32, stats=stats, **params)
+    spans = note_spans(notes, sample_rate) if notes else (np.zeros(0, dtype=np.int64),) * 4
+    order = np.argsort(spans[0], kind='stable')
+    spans = tuple(column[order] for column in spans)
+    limiter = None
+    segment = max(1, int(head_seconds * sample_rate))
+    first = 0
+    while True:
+        end = min(audio.ready + segment, length)
+        # every note starting before `end` is mixed, so nothing can change the samples before it any more
+        last = int(np.searchsorted(spans[0], end))
+        if last > first:
+            note_progress = None if progress is None else (
+                lambda fraction, first=first, last=last: progress((first + fraction * (last - first)) / len(order)))
+            mix_notes(samples, 0, tuple(column[first:last] for column in spans), render_note, stats, note_progress)
+        block = samples[audio.ready:end]
+        if limiter is None:
+            peak = max(float(np.max(np.abs(block))) if len(block) else 0.0,
+                       PREVIEW_VOICE_PEAK * np.sqrt(_max_polyphony(spans)))
+            gain = 1 / (peak * 1.4) if peak > 0 else 1.0
+            limiter = {'gain': gain, 'current': gain}
+        limit_block(block, limiter)
+        audio._pcm[audio.ready:end] = to_pcm16(block)
+        audio._peaks.append(block)
+        first = last
+        audio.ready = end
+        if end >= length:
+            audio._peaks.finish()
+            yield audio
+            return
+        yield audio
+        segment *= 2
+
+
+def limit_block(block, state, ceiling=1 / 1.4, release=0.999, scratch=None):
+    """
+    Streaming-safe replacement for the global peak normalization
+
+    The gain never lets a sample exceed the ceiling: it drops at once for a
+    louder block and recovers towards the make-up gain with a per-sample
+    release, ramped across the block so there are no steps.
+
+    param：
+    - block: samples, scaled in place
+    - state: dict with 'gain' (make-up gain) and 'current' (gain in use)
+    - ceiling: output peak, matches the 1 / 1.4 of generate_audio
+    - release: per-sample recovery factor of the gain reduction
+    - scratch: optional float64 buffer of at least len(block) samples to
+      build the gain ramp in, so a real-time caller does not allocate one
+
+    return：
+    the scaled block
+    """
+    if len(block) == 0:
+        return block
+    peak = max(block.max(), -block.min())
+    target = state['gain']
+    if peak * target > ceiling:
+        target = ceiling / peak
+    current = state['current']
+    if target <= current:
+        # a steady gain needs no ramp
+        block *= np.float64(target)
+    else:
+        recovered = target - (target - current) * release ** len(block)
+        if scratch is None:
+            block *= np.linspace(current, recovered, len(block))
+        else:
+            ramp = scratch[:len(block)]
+            ramp.fill((recovered - current) / max(1, len(block) - 1))
+            ramp[0] = current
+            np.add.accumulate(ramp, out=ramp)
+            block *= ramp
+        target = recovered
+    state['current'] = target
+    return block
+
+
+def stream_audio(notes, block_size=4096, sample_rate=44100, noise_ratio=0.1,
+                 adsr_params=(0.01, 0.1, 0.7, 0.1), oscillator='signal', noise_seed=0, gain=0.5):
+    """
+    Render the same mix as generate_audio as consecutive blocks
+
+    Only the notes sounding in the current block are kept; each is
+    synthesized when the block reaches its start and dropped after its end,
+    so memory follows the polyphony rather than the song length.
+
+    param：
+    - notes: NoteTable or list of (start_time, duration, pitch)
+    - block_size: samples per yielded block (the last one may be shorter)
+    - gain: make-up gain in front of the limiter (see limit_block)
+    - other parameters as generate_audio
+
+    return：
+    generator of float64 blocks in time order
+    """
+    if not notes:
+        return
+
+    total_length = audio_length(notes, sample_rate)
+    render_note = make_note_renderer(sample_rate, noise_ratio, adsr_params, oscillator, noise_seed)
+    limiter = {'gain': gain, 'current': gain}
+    start_samples, note_lengths, durations, pitches = note_spans(notes, sample_rate)
+    order = np.argsort(start_samples, kind='stable')
+    pending = zip(start_samples[order].tolist(), note_lengths[order].tolist(),
+                  durations[order].tolist(), pitches[order].tolist())
+    upcoming = next(pending, None)
+    active = []
+
+    for block_start in range(0, total_length, block_size):
+        block_end = min(block_start + block_size, total_length)
+        block = np.zeros(block_end - block_start)
+
+        while upcoming is not None and upcoming[0] < block_end:
+            start_sample, total_samples, dur, pitch = upcoming
+            upcoming = next(pending, None)
+            if total_samples <= 0:
+                continue
+            mixed = render_note(dur, pitch, total_samples, start_sample)
+            active.append((start_sample, mixed[:total_length - start_sample]))
+
+        still_active = []
+        for start_sample, mixed in active:
+            note_end = start_sample + len(mixed)
+            lo = max(block_start, start_sample)
+            hi = min(block_end, note_end)
+            if hi > lo:
+                block[lo - block_start:hi - block_start] += mixed[lo - start_sample:hi - start_sample]
+            if note_end > block_end:
+                still_active.append((start_sample, mixed))
+        active = still_active
+
+        yield limit_block(block, limiter)
+
+
 if __name__ == '__main__':
+    import sounddevice as sd
+    from conversion_cache import default_cache
+
     midi_file = 'dataset/Lemon-Tree.mid'  
-    notes = parse_midi(midi_file)
-    audio = generate_audio(notes)
+    audio = default_cache().load_audio(midi_file)
 
     # 播放音频
     sd.play(audio, 44100)
@@ -0,0 +1,174 @@
+import numpy as np
+from scipy import signal
+
+from blackboard import (NoteTable, apply_adsr, audio_length, note_spans, pitch_to_freq, to_pcm16,
+                        wavetable_oscillator)
+
+# MIDI channel 10 (index 9) is General MIDI percussion
+DRUM_CHANNEL = 9
+# notes below this pitch prefer the triangle, like the bass lines written for it
+BASS_PITCH = 52
+LFSR_TABLE_SIZE = 2 ** 15
+
+# voices of each console and their level in the mix
+VOICE_LAYOUTS = {
+    'nes': (('pulse50', 0.5), ('pulse25', 0.5), ('triangle', 0.6), ('noise', 0.35)),
+    'gameboy': (('pulse50', 0.5), ('pulse12', 0.5), ('wave', 0.5), ('noise', 0.35)),
+}
+
+_voice_tables = {}
+
+
+def get_voice_tables(size=4096):
+    '''
+    Single-cycle tables of the console voices, built once per size
+
+    - pulse50 / pulse25 / pulse12: pulse waves of 50%, 25% and 12.5% duty
+    - triangle: 4-bit stepped triangle of the NES triangle channel
+    - wave: smooth triangle standing in for the GameBoy wave channel
+    - noise: one period of a 15-bit LFSR, read like a table (LFSR_TABLE_SIZE samples)
+    '''
+    if size not in _voice_tables:
+        phase = 2 * np.pi * np.arange(size) / size
+        triangle = signal.sawtooth(phase, 0.5)
+        lfsr = np.empty(LFSR_TABLE_SIZE)
+        register = 1
+        for i in range(LFSR_TABLE_SIZE):
+            lfsr[i] = 1.0 if register & 1 else -1.0
+            feedback = (register ^ (register >> 1)) & 1
+            register = (register >> 1) | (feedback << 14)
+        _voice_tables[size] = {
+            'pulse50': signal.square(phase, duty=0.5),
+            'pulse25': signal.square(phase, duty=0.25),
+            'pulse12': signal.square(phase, duty=0.125),
+            'triangle': np.round(triangle * 7.5) / 7.5,
+            'wave': triangle,
+            'noise': lfsr,
+        }
+    return _voice_tables[size]
+
+
+def allocate_voices(notes, voices, sample_rate=44100, stats=None):
+    '''
+    Assign every note to one console voice
+
+    Percussion (MIDI channel 10) goes to the noise voices, everything else
+    to the tonal ones; notes below BASS_PITCH try the triangle first, the
+    others the pulses first. Notes starting together are placed highest
+    pitch first, so melodies keep a voice. When every candidate is busy the
+    note that started earliest is cut short (stolen); if all of them
+    started at the same sample the new note is dropped.
+
+    :param notes: NoteTable or list of (start_time, duration, pitch)
+    :param voices: voice names, e.g. the names of a VOICE_LAYOUTS entry
+    :param stats: optional ConversionStats, counts 'voice_steals' and 'dropped_notes'
+    :return: (voice index per note or -1 when dropped, start samples, lengths after stealing)
+    '''
+    if not isinstance(notes, NoteTable):
+        notes = NoteTable.from_notes(notes)
+    start_samples, lengths, _, pitches = note_spans(notes, sample_rate)
+    lengths = lengths.copy()
+    drums = notes.channel == DRUM_CHANNEL
+    assigned = np.full(len(notes), -1, dtype=np.int64)
+
+    noise = [v for v, name in enumerate(voices) if name == 'noise']
+    pulses = [v for v, name in enumerate(voices) if name.startswith('pulse')]
+    low = [v for v, name in enumerate(voices) if name in ('triangle', 'wave')]
+    preferences = {'drum': noise, 'high': pulses + low, 'low': low + pulses}
+
+    busy_until = [0] * len(voices)
+    playing = [-1] * len(voices)
+    steals = dropped = 0
+    order = np.lexsort((-pitches, start_samples))
+    for i, start, length, pitch, drum in zip(order.tolist(), start_samples[order].tolist(), lengths[order].tolist(),
+                                             pitches[order].tolist(), drums[order].tolist()):
+        if length <= 0:
+            continue
+        candidates = preferences['drum' if drum else 'low' if pitch < BASS_PITCH else 'high']
+        voice = next((v for v in candidates if busy_until[v] <= start), None)
+        if voice is None and candidates:
+            oldest = min(candidates, key=lambda v: start_samples[playing[v]])
+            if start_samples[playing[oldest]] < start:
+                voice = oldest
+                lengths[playing[voice]] = start - start_samples[playing[voice]]
+                steals += 1
+        if voice is None:
+            dropped += 1
+            continue
+        assigned[i] = voice
+        busy_until[voice] = start + length
+        playing[voice] = i
+    if stats is not None:
+        stats.count('voice_steals', steals)
+        stats.count('dropped_notes', dropped)
+    return assigned, start_samples, lengths
+
+
+def render_channels(notes, sample_rate=44100, layout='nes', adsr_params=(0.01, 0.1, 0.7, 0.1),
+                    dtype=np.float64, stats=None, progress=None):
+    """
+    Render the notes through a fixed set of console voices
+
+    Each voice plays one note at a time as a single continuous-phase
+    stream, so the work grows with song length times voice count instead of
+    with the number of overlapping notes. Output is normalized like
+    generate_audio.
+
+    param：
+    - notes: NoteTable (channels pick the percussion) or list of (start_time, duration, pitch)
+    - layout: key of VOICE_LAYOUTS, 'nes' (2 pulse, triangle, noise) or 'gameboy'
+    - adsr_params, dtype, stats, progress: as generate_audio
+
+    return：
+    audio array
+    """
+    if layout not in VOICE_LAYOUTS:
+        raise ValueError(f"Unknown layout: {layout}")
+    dtype = np.dtype(dtype)
+    pcm = dtype == np.int16
+    mix_dtype = np.dtype(np.float32) if pcm else dtype
+    if not notes:
+        return np.zeros(0, dtype=dtype)
+
+    lap = stats.lap() if stats is not None else (lambda name: None)
+    voices = VOICE_LAYOUTS[layout]
+    assigned, start_samples, lengths = allocate_voices(notes, [name for name, _ in voices], sample_rate, stats)
+    pitches = note_spans(notes, sample_rate)[3]
+    lap('voice_allocation')
+
+    length = audio_length(notes, sample_rate)
+    audio = np.zeros(length, dtype=mix_dtype)
+    if stats is not None:
+        stats.buffer('output', audio.nbytes)
+    tables = get_voice_tables()
+    for v, (name, level) in enumerate(voices):
+        selected = np.nonzero(assigned == v)[0]
+        if not len(selected):
+            continue
+        table = (tables[name] * level).astype(mix_dtype)
+        scratch = np.empty(int(lengths[selected].max()), dtype=mix_dtype)
+        phase = 0.0
+        for start, total, pitch in zip(start_samples[selected].tolist(), lengths[selected].tolist(),
+                                       pitches[selected].tolist()):
+            freq = pitch_to_freq(pitch)
+            if name == 'noise':
+                # the pitch sets the LFSR clock: low drums rumble, cymbals hiss
+                freq = min(sample_rate, freq * 128) / len(table)
+            # the phase carries over from the previous note, the voice never restarts its oscillator
+            mixed, phase = wavetable_oscillator(table, freq, total, sample_rate, phase, out=scratch[:total])
+            apply_adsr(mixed, adsr_params, sample_rate)
+            audio[start:start + total] += mixed
+        if stats is not None:
+            stats.count('rendered_notes', len(selected))
+        lap(f'voice_{name}')
+        if progress is not None:
+            progress((v + 1) / len(voices))
+
+    peak = max(audio.max(), -audio.min())
+    if peak > 0:
+        audio /= peak * 1.4
+    lap('normalization')
+    if pcm:
+        audio = to_pcm16(audio)
+        lap('pcm_conversion')
+    return audio
@@ -0,0 +1,223 @@
+import hashlib
+import inspect
+import json
+import os
+
+import numpy as np
+
+from blackboard import NoteTable, parse_midi_table, generate_audio, render_stems
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "PIXELTONE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "pixeltone"))
+
+# part of every entry name; bump it when parsing or synthesis changes their output, so
+# old entries are no longer served (they age out of the levels like any other entry)
+CACHE_FORMAT = 1
+
+
+def file_digest(file_path):
+    '''
+    sha256 of the file content, so renamed or copied songs share cache entries
+    '''
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def params_digest(params):
+    '''
+    Stable hash of the synthesis parameters (sample_rate, noise_ratio, adsr_params, style, ...)
+    '''
+    encoded = json.dumps(params, sort_keys=True, default=repr)
+    return hashlib.sha256(encoded.encode()).hexdigest()[:16]
+
+
+def render_digest(render, params):
+    '''
+    params_digest of params merged over the defaults of render (generate_audio or render_stems)
+
+    Spelling a default out gives the same key as leaving it out. Returns None
+    when noise_seed is None: every such render draws a fresh noise bank, so
+    it is not repeatable and must not be cached.
+    '''
+    full = {name: parameter.default for name, parameter in inspect.signature(render).parameters.items()
+            if parameter.default is not parameter.empty and name not in ("stats", "progress")}
+    full.update(params)
+    if full.get("noise_seed", 0) is None:
+        return None
+    if "dtype" in full:
+        full["dtype"] = np.dtype(full["dtype"]).name
+    return params_digest(full)
+
+
+class ConversionCache:
+    """
+    Two-level content-addressed cache of conversion results
+
+    Level one stores parsed NoteTables, level two rendered audio. Entries
+    are .npy files opened memory-mapped, and each level is trimmed to its
+    size budget by evicting the least recently used files (access time is
+    tracked through the file mtime).
+    """
+
+    def __init__(self, root=DEFAULT_CACHE_DIR, max_notes_bytes=64 << 20, max_audio_bytes=2 << 30):
+        self.root = root
+        self.limits = {"notes": max_notes_bytes, "audio": max_audio_bytes}
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, level, key):
+        return os.path.join(self.root, level, f"{key}-v{CACHE_FORMAT}.npy")
+
+    def _load(self, level, key):
+        path = self._path(level, key)
+        try:
+            array = np.load(path, mmap_mode="r")
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted by another process sharing the cache; the open mapping stays valid
+            pass
+        self.hits += 1
+        return array
+
+    def _store(self, level, key, array):
+        path = self._path(level, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(tmp_path, path)
+        except BaseException:
+            # disk full or interrupted: never leave a partial file the budget does not count
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        self.evict(level)
+
+    def evict(self, level):
+        '''
+        Remove least recently used entries until the level fits its budget
+        '''
+        directory = os.path.join(self.root, level)
+        try:
+            entries = [e for e in os.scandir(directory) if e.name.endswith(".npy")]
+        except FileNotFoundError:
+            return
+        stats = []
+        for e in entries:
+            try:
+                stat = e.stat()
+            except FileNotFoundError:
+                # removed by another process sharing the cache
+                continue
+            stats.append((stat.st_mtime, stat.st_size, e.path))
+        total = sum(size for _, size, _ in stats)
+        for _, size, path in sorted(stats):
+            if total <= self.limits[level]:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for level in self.limits:
+            limit = self.limits[level]
+            self.limits[level] = 0
+            self.evict(level)
+            self.limits[level] = limit
+
+    def load_notes(self, midi_path, digest=None, stats=None):
+        '''
+        NoteTable for a MIDI file, parsed only when its content is not cached
+
+        :param digest: content hash if already known
+        :param stats: optional ConversionStats
+        '''
+        digest = digest or file_digest(midi_path)
+        data = self._load("notes", digest)
+        if stats is not None:
+            stats.count("notes_cache_hits" if data is not None else "notes_cache_misses")
+        if data is None:
+            notes = parse_midi_table(midi_path, stats=stats)
+            self._store("notes", digest, notes.data)
+            return notes
+        return NoteTable(data)
+
+    def load_audio(self, midi_path, stats=None, progress=None, **params):
+        '''
+        Rendered audio for a MIDI file and synthesis parameters
+
+        :param stats: optional ConversionStats, also filled on a miss
+        :param progress: optional callable(fraction done) passed to generate_audio
+        :param params: generate_audio keyword arguments; extra keys such as
+            style only take part in the cache key. With noise_seed=None the
+            audio is rendered every time and not stored.
+        :return: float array, read-only and memory-mapped on a cache hit
+        '''
+        lap = stats.lap() if stats is not None else (lambda name: None)
+        digest = file_digest(midi_path)
+        params_key = render_digest(generate_audio, params)
+        key = params_key and f"{digest}-{params_key}"
+        audio = self._load("audio", key) if key else None
+        lap("cache_lookup")
+        if stats is not None:
+            stats.count("audio_cache_hits" if audio is not None else "audio_cache_misses")
+        if audio is None:
+            notes = self.load_notes(midi_path, digest, stats)
+            render_params = {k: v for k, v in params.items() if k != "style"}
+            audio = generate_audio(notes, stats=stats, progress=progress, **render_params)
+            if key:
+                self._store("audio", key, audio)
+        return audio
+
+    def cached_stems(self, midi_path, stats=None, digest=None, **params):
+        '''
+        Stems of a MIDI file if they are cached, else None; never renders
+
+        :param params: render_stems keyword arguments
+        '''
+        digest = digest or file_digest(midi_path)
+        params_key = render_digest(render_stems, params)
+        stems = self._load("audio", f"{digest}-stems-{params_key}") if params_key else None
+        if stats is not None:
+            stats.count("audio_cache_hits" if stems is not None else "audio_cache_misses")
+        return stems
+
+    def load_stems(self, midi_path, stats=None, progress=None, **params):
+        '''
+        Square / triangle / noise stems of a MIDI file, see blackboard.render_stems
+
+        Stems do not depend on the mix ratios, so one entry serves every mix.
+
+        :param params: render_stems keyword arguments
+        :return: (3, samples) float array, read-only and memory-mapped on a cache hit
+        '''
+        digest = file_digest(midi_path)
+        stems = self.cached_stems(midi_path, stats, digest, **params)
+        if stems is None:
+            notes = self.load_notes(midi_path, digest, stats)
+            stems = render_stems(notes, stats=stats, progress=progress, **params)
+            params_key = render_digest(render_stems, params)
+            if params_key:
+                self._store("audio", f"{digest}-stems-{params_key}", stems)
+        return stems
+
+_default_cache = None
+
+
+def default_cache():
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ConversionCache()
+    return _default_cache
@@ -0,0 +1,434 @@
+import argparse
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import wave
+from collections import OrderedDict, deque
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from blackboard import ConversionCancelled, ConversionStats, generate_audio, get_noise_bank, get_wavetables, to_pcm16
+from conversion_cache import DEFAULT_CACHE_DIR, ConversionCache, render_digest
+
+DEFAULT_PORT = 8765
+MAX_MIDI_BYTES = 16 << 20
+# latencies kept for the percentiles in /metrics
+LATENCY_WINDOW = 1024
+DEFAULT_PARAMS = {"sample_rate": 44100, "noise_ratio": 0.1, "oscillator": "wavetable", "noise_seed": 0,
+                  "adsr_params": (0.01, 0.1, 0.7, 0.1)}
+
+
+class ServiceBusy(Exception):
+    """
+    Raised when the request queue is full
+    """
+
+
+class ConversionTimeout(Exception):
+    """
+    Raised when a conversion did not finish within its request's timeout
+    """
+
+
+def parse_params(query):
+    '''
+    generate_audio keyword arguments from a query string
+
+    :param query: dict name -> list of values, as parse_qs returns
+    :return: DEFAULT_PARAMS updated with the given values
+    :raise ValueError: unknown or out of range parameter
+    '''
+    params = dict(DEFAULT_PARAMS)
+    for name, values in query.items():
+        value = values[-1]
+        if name == "timeout":
+            continue
+        if name in ("sample_rate", "noise_seed"):
+            params[name] = int(value)
+        elif name == "noise_ratio":
+            params[name] = float(value)
+        elif name == "oscillator":
+            params[name] = value
+        elif name == "adsr":
+            params["adsr_params"] = tuple(float(v) for v in value.split(","))
+        else:
+            raise ValueError(f"unknown parameter {name}")
+    if not 8000 <= params["sample_rate"] <= 192000:
+        raise ValueError("sample_rate must be between 8000 and 192000")
+    if not 0.0 <= params["noise_ratio"] <= 1.0:
+        raise ValueError("noise_ratio must be between 0 and 1")
+    if params["oscillator"] not in ("signal", "wavetable"):
+        raise ValueError("oscillator must be signal or wavetable")
+    if len(params["adsr_params"]) != 4:
+        raise ValueError("adsr needs attack,decay,sustain,release")
+    return params
+
+
+def encode_wav(audio, sample_rate):
+    '''
+    16-bit mono WAV file content of float audio in [-1, 1]
+    '''
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as writer:
+        writer.setnchannels(1)
+        writer.setsampwidth(2)
+        writer.setframerate(sample_rate)
+        writer.writeframes(to_pcm16(audio).tobytes())
+    return buffer.getvalue()
+
+
+_worker_cache = None
+_worker_deadlines = None
+
+
+def _warm_worker(cache_root, deadlines_name, slots):
+    # runs once per pool process: the imports and tables every conversion needs are ready before the first request
+    global _worker_cache, _worker_deadlines
+    _worker_cache = ConversionCache(cache_root)
+    shm = shared_memory.SharedMemory(name=deadlines_name)
+    # the mapping has to outlive this function, so it is kept with the array
+    _worker_deadlines = (shm, np.ndarray(slots, dtype=np.float64, buffer=shm.buf))
+    get_wavetables()
+    get_noise_bank(DEFAULT_PARAMS["sample_rate"])
+
+
+def _ping():
+    return os.getpid()
+
+
+def _convert(midi_bytes, digest, params, slot, submitted):
+    '''
+    Pool worker: MIDI bytes -> WAV bytes through the worker's ConversionCache
+
+    The song goes to a temporary file for the length of the conversion;
+    the notes and audio cache levels are keyed by its content, so they
+    still serve repeated requests. The deadline is read from the shared
+    deadline slot at every progress report, so identical requests joining
+    later can extend it; past it the render is abandoned.
+
+    :return: (wav bytes, queue wait seconds, conversion seconds, True on an audio cache hit)
+    '''
+    started = time.time()
+    deadlines = _worker_deadlines[1]
+
+    def progress(fraction):
+        if time.time() > deadlines[slot]:
+            raise ConversionCancelled(digest)
+
+    stats = ConversionStats()
+    fd, midi_path = tempfile.mkstemp(suffix=".mid")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(midi_bytes)
+        audio = _worker_cache.load_audio(midi_path, stats=stats, progress=progress, **params)
+    finally:
+        os.remove(midi_path)
+    wav = encode_wav(np.asarray(audio), params["sample_rate"])
+    return wav, started - submitted, time.time() - started, bool(stats.counters.get("audio_cache_hits"))
+
+
+class ServiceMetrics:
+    """
+    Counters and recent latencies of a ConversionService, read by /metrics
+    """
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.counters = {"requests": 0, "completed": 0, "rejected": 0, "timeouts": 0, "errors": 0,
+                         "result_cache_hits": 0, "audio_cache_hits": 0}
+        self.latencies = {"total": deque(maxlen=window), "queue_wait": deque(maxlen=window),
+                          "convert": deque(maxlen=window)}
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def observe(self, name, seconds):
+        with self._lock:
+            self.latencies[name].append(seconds)
+
+    def to_dict(self):
+        with self._lock:
+            report = {"counters": dict(self.counters), "latency": {}}
+            for name, values in self.latencies.items():
+                if values:
+                    p50, p95, p99 = np.percentile(np.array(values), [50, 95, 99])
+                    report["latency"][name] = {"count": len(values), "mean": float(np.mean(values)),
+                                               "p50": float(p50), "p95": float(p95), "p99": float(p99)}
+        return report
+
+
+class ConversionService:
+    """
+    MIDI -> WAV conversions on a pool of warm worker processes
+
+    At most workers + queue_size requests are admitted at once; the next
+    one raises ServiceBusy instead of waiting. Every request has a deadline
+    that the worker checks while rendering, so a timed-out conversion frees
+    its process instead of finishing for nobody. Finished WAVs are kept in
+    an in-memory LRU (result_cache_bytes), and the workers'
+    ConversionCache keeps parsed notes and rendered audio on disk.
+
+    Identical requests in flight share one conversion. Its deadline lives
+    in a shared-memory slot that each joining request raises to its own,
+    so the conversion runs until the last waiter gives up, and a waiter
+    timing out early leaves it in flight for the others.
+    """
+
+    def __init__(self, workers=None, queue_size=16, timeout=60.0, cache_root=DEFAULT_CACHE_DIR,
+                 result_cache_bytes=256 << 20):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.result_cache_bytes = result_cache_bytes
+        self.metrics = ServiceMetrics()
+        # one deadline per conversion that can be admitted at once, shared with the workers
+        slots = self.workers + queue_size
+        self._deadline_memory = shared_memory.SharedMemory(create=True, size=slots * 8)
+        self._deadlines = np.ndarray(slots, dtype=np.float64, buffer=self._deadline_memory.buf)
+        self._free_slots = list(range(slots))
+        # spawned, not forked: the server process runs request threads
+        self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=_warm_worker,
+                                        initargs=(cache_root, self._deadline_memory.name, slots))
+        self.results = OrderedDict()
+        self._result_bytes = 0
+        # key -> (future, deadline slot) of the conversions running or queued
+        self._inflight = {}
+        self._admitted = 0
+        self._lock = threading.RLock()
+
+    def warm_up(self):
+        '''
+        Start every worker process now rather than on the first requests
+        '''
+        wait([self.pool.submit(_ping) for _ in range(self.workers)])
+
+    @property
+    def queue_depth(self):
+        return max(0, self._admitted - self.workers)
+
+    def status(self):
+        report = self.metrics.to_dict()
+        report.update(workers=self.workers, queue_size=self.queue_size, in_flight=self._admitted,
+                      queue_depth=self.queue_depth, result_cache_entries=len(self.results),
+                      result_cache_bytes=self._result_bytes)
+        return report
+
+    def convert(self, midi_bytes, params, timeout=None):
+        '''
+        Convert one song, from the result cache when possible
+
+        :param params: generate_audio keyword arguments, see parse_params
+        :param timeout: seconds, at most the service timeout
+        :return: (wav bytes, True when served from a cache)
+        :raise ServiceBusy: the queue is full
+        :raise ConversionTimeout: not done within the timeout
+        '''
+        start = time.perf_counter()
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        deadline = time.time() + timeout
+        self.metrics.count("requests")
+        digest = hashlib.sha256(midi_bytes).hexdigest()
+        # the same key as the worker's audio cache entry; parse_params always sets an integer noise_seed
+        key = f"{digest}-{render_digest(generate_audio, params)}"
+        from_cache = False
+        while True:
+            with self._lock:
+                wav = self.results.get(key)
+                if wav is not None:
+                    self.results.move_to_end(key)
+                    from_cache = True
+                    break
+                future, slot = self._inflight.get(key, (None, None))
+                if future is not None and not future.done() and self._deadlines[slot] > time.time():
+                    # join it, keeping it alive at least as long as this request waits
+                    self._deadlines[slot] = max(self._deadlines[slot], deadline)
+                else:
+                    # nothing in flight, or one being abandoned at its deadline: start afresh
+                    future = self._submit(key, midi_bytes, digest, params, deadline)
+            try:
+                wav, queue_wait, convert_time, cached = future.result(max(0.0, deadline - time.time()))
+            except FutureTimeout:
+                self.metrics.count("timeouts")
+                raise ConversionTimeout(f"not converted within {timeout:g}s")
+            except ConversionCancelled:
+                if time.time() < deadline:
+                    # reached an earlier waiter's deadline just as this request joined
+                    continue
+                self.metrics.count("timeouts")
+                raise ConversionTimeout(f"not converted within {timeout:g}s")
+            except Exception:
+                self.metrics.count("errors")
+                raise
+            break
+        if from_cache:
+            self.metrics.count("result_cache_hits")
+            self.metrics.observe("total", time.perf_counter() - start)
+            return wav, True
+
+        self.metrics.count("completed")
+        if cached:
+            self.metrics.count("audio_cache_hits")
+        self.metrics.observe("queue_wait", queue_wait)
+        self.metrics.observe("convert", convert_time)
+        self.metrics.observe("total", time.perf_counter() - start)
+        return wav, cached
+
+    def _submit(self, key, midi_bytes, digest, params, deadline):
+        # called with the lock held
+        if self._admitted >= self.workers + self.queue_size:
+            self.metrics.count("rejected")
+            raise ServiceBusy(f"{self._admitted} conversions in progress")
+        slot = self._free_slots.pop()
+        self._deadlines[slot] = deadline
+        try:
+            future = self.pool.submit(_convert, midi_bytes, digest, params, slot, time.time())
+        except Exception:
+            self._free_slots.append(slot)
+            self.metrics.count("errors")
+            raise
+        self._admitted += 1
+        self._inflight[key] = (future, slot)
+        # runs right here if the future is already done, hence the reentrant lock
+        future.add_done_callback(lambda done, key=key, slot=slot: self._finished(key, slot, done))
+        return future
+
+    def _finished(self, key, slot, future):
+        with self._lock:
+            self._admitted -= 1
+            self._free_slots.append(slot)
+            if self._inflight.get(key, (None,))[0] is future:
+                del self._inflight[key]
+            if future.cancelled() or future.exception() is not None:
+                return
+            wav = future.result()[0]
+            if len(wav) > self.result_cache_bytes:
+                return
+            self.results[key] = wav
+            self._result_bytes += len(wav)
+            while self._result_bytes > self.result_cache_bytes:
+                _, evicted = self.results.popitem(last=False)
+                self._result_bytes -= len(evicted)
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self._deadlines = None
+        self._deadline_memory.close()
+        self._deadline_memory.unlink()
+
+
+class ConversionHandler(BaseHTTPRequestHandler):
+    """
+    POST /convert?sample_rate=..&noise_ratio=..&oscillator=..&noise_seed=..&adsr=a,d,s,r&timeout=..
+        with the MIDI file as the body -> audio/wav
+    GET /metrics -> JSON counters, queue depth and latency percentiles
+    GET /health -> ok
+    """
+
+    service = None
+    quiet = False
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/metrics":
+            self._reply(200, json.dumps(self.service.status(), indent=2).encode(), "application/json")
+        elif path == "/health":
+            self._reply(200, b"ok\n", "text/plain")
+        else:
+            self._reply(404, b"not found\n", "text/plain")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/convert":
+            self._reply(404, b"not found\n", "text/plain")
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if not 0 < length <= MAX_MIDI_BYTES:
+            self._reply(413 if length else 411, b"send the MIDI file as the request body\n", "text/plain")
+            return
+        midi_bytes = self.rfile.read(length)
+        query = parse_qs(url.query)
+        try:
+            params = parse_params(query)
+            timeout = float(query["timeout"][-1]) if "timeout" in query else None
+        except ValueError as e:
+            self._reply(400, f"{e}\n".encode(), "text/plain")
+            return
+        try:
+            wav, cached = self.service.convert(midi_bytes, params, timeout)
+        except ServiceBusy as e:
+            self._reply(503, f"busy: {e}\n".encode(), "text/plain", {"Retry-After": "1"})
+        except ConversionTimeout as e:
+            self._reply(504, f"{e}\n".encode(), "text/plain")
+        except Exception as e:
+            self._reply(422, f"conversion failed: {e}\n".encode(), "text/plain")
+        else:
+            self._reply(200, wav, "audio/wav", {"X-Cache": "hit" if cached else "miss"})
+
+    def _reply(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+
+def make_server(service, host="127.0.0.1", port=DEFAULT_PORT, quiet=False):
+    '''
+    HTTP server bound to the service; call serve_forever() on it (port 0 picks a free one)
+    '''
+    handler = type("BoundConversionHandler", (ConversionHandler,), {"service": service, "quiet": quiet})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Serve MIDI to 8-bit WAV conversions over local HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument("--queue-size", type=int, default=16,
+                        help="requests waiting for a worker before new ones get 503")
+    parser.add_argument("--timeout", type=float, default=60.0, help="longest a request may take, in seconds")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="notes / audio cache of the workers")
+    parser.add_argument("--result-cache-mb", type=int, default=256, help="finished WAVs kept in memory")
+    parser.add_argument("--quiet", action="store_true", help="do not log every request")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    service = ConversionService(args.workers, args.queue_size, args.timeout, args.cache_dir,
+                                args.result_cache_mb << 20)
+    service.warm_up()
+    server = make_server(service, args.host, args.port, args.quiet)
+    print(f"Serving on http://{args.host}:{server.server_address[1]} with {service.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,105 @@
+import queue
+import threading
+from collections import deque
+
+from blackboard import ConversionCancelled
+
+
+class ConversionWorker:
+    """
+    Runs conversions on a background thread so the UI loop never blocks
+
+    Jobs are taken from a queue one at a time; taking one and making it
+    `current` happen under the same lock as cancelling, so a job is always
+    either queued or current and can never miss its cancel. Submitting a new job cancels
+    the one in progress: the render's progress callback raises
+    ConversionCancelled at its next report. The UI thread reads `progress`
+    (0.0-1.0, None when idle) and calls poll() once per frame to collect
+    ('done' | 'error' | 'cancelled', job, payload) events, plus whatever
+    convert posts through publish() on the way.
+    """
+
+    def __init__(self, convert):
+        '''
+        :param convert: callable(path, progress) -> result, run on the worker thread
+        '''
+        self.convert = convert
+        self.jobs = deque()
+        self.events = queue.Queue()
+        self.current = None
+        self.progress = None
+        self._lock = threading.Lock()
+        self._queued = threading.Condition(self._lock)
+        self._thread = threading.Thread(target=self._run, name="conversion-worker", daemon=True)
+        self._thread.start()
+
+    @property
+    def busy(self):
+        return self.current is not None or bool(self.jobs)
+
+    def submit(self, path, task=None):
+        '''
+        Queue a conversion, abandoning the running and queued ones
+
+        :param task: optional callable(path, progress) run for this job instead of convert
+        :return: job dict, also carried by the events about it
+        '''
+        job = {"path": path, "cancel": threading.Event(), "task": task}
+        with self._lock:
+            self._cancel_locked()
+            self.jobs.append(job)
+            self._queued.notify()
+        return job
+
+    def cancel(self):
+        with self._lock:
+            self._cancel_locked()
+
+    def _cancel_locked(self):
+        while self.jobs:
+            self.events.put(("cancelled", self.jobs.popleft(), None))
+        if self.current is not None:
+            self.current["cancel"].set()
+
+    def publish(self, kind, payload):
+        '''
+        Post an intermediate result of the running job (e.g. a preview); call from convert
+        '''
+        self.events.put((kind, self.current, payload))
+
+    def poll(self):
+        '''
+        Events produced since the last call, oldest first
+        '''
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def _run(self):
+        while True:
+            with self._queued:
+                while not self.jobs:
+                    self._queued.wait()
+                job = self.current = self.jobs.popleft()
+            self.progress = 0.0
+
+            def report(fraction, job=job):
+                if job["cancel"].is_set():
+                    raise ConversionCancelled(job["path"])
+                self.progress = fraction
+
+            try:
+                result = (job["task"] or self.convert)(job["path"], report)
+            except ConversionCancelled:
+                self.events.put(("cancelled", job, None))
+            except Exception as e:
+                self.events.put(("error", job, e))
+            else:
+                self.events.put(("done", job, result))
+            finally:
+                with self._lock:
+                    self.current = None
+                self.progress = None
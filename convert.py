@@ -0,0 +1,191 @@
+import argparse
+import json
+import os
+import time
+from multiprocessing import Pool
+
+from blackboard import ConversionStats, audio_length, parse_midi_table, generate_audio
+from console_channels import VOICE_LAYOUTS, render_channels
+from export import EXPORT_FORMATS, export_bits, export_samples, render_to_file
+
+OUTPUT_SUFFIX = "_converted"
+RENDERERS = {"notes": generate_audio, "channels": render_channels}
+
+
+def find_midi_files(paths):
+    '''
+    Collect every .mid under the given files / directory trees
+
+    :param paths: files or directories
+    :return: sorted list of MIDI file paths
+    '''
+    found = []
+    for path in paths:
+        if os.path.isfile(path):
+            found.append(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in files:
+                if name.lower().endswith(".mid"):
+                    found.append(os.path.join(root, name))
+    return sorted(found)
+
+
+def output_path_for(midi_path, input_root, output_dir, fmt="wav"):
+    '''
+    Where the converted file goes: next to the MIDI file, or mirrored under output_dir
+    '''
+    base = os.path.splitext(midi_path)[0] + OUTPUT_SUFFIX + "." + fmt
+    if output_dir is None:
+        return base
+    rel = os.path.relpath(base, input_root) if input_root else os.path.basename(base)
+    return os.path.join(output_dir, rel)
+
+
+def is_up_to_date(midi_path, wav_path):
+    return os.path.exists(wav_path) and os.path.getmtime(wav_path) >= os.path.getmtime(midi_path)
+
+
+def convert_file(job):
+    '''
+    Worker: parse, render and write one file
+
+    :param job: (midi_path, output path, RENDERERS key, synthesis kwargs, (format, bits, low_memory),
+        collect ConversionStats)
+    :return: dict with per-file statistics, or the error message
+    '''
+    midi_path, wav_path, engine, params, (fmt, bits, low_memory), instrument = job
+    result = {"midi": midi_path, "wav": wav_path}
+    stats = ConversionStats() if instrument else None
+    try:
+        t0 = time.perf_counter()
+        notes = parse_midi_table(midi_path, stats=stats)
+        t1 = time.perf_counter()
+        os.makedirs(os.path.dirname(wav_path) or ".", exist_ok=True)
+        if low_memory:
+            # rendered through a scratch file and encoded chunk by chunk, the song is never in RAM
+            render_to_file(notes, wav_path, fmt, bits, stats=stats,
+                           **{k: v for k, v in params.items() if k != "workers"})
+            t2 = t3 = time.perf_counter()
+        else:
+            audio = RENDERERS[engine](notes, dtype="int16", stats=stats, **params)
+            t2 = time.perf_counter()
+            export_samples(audio, wav_path, params["sample_rate"], fmt, bits)
+            t3 = time.perf_counter()
+    except Exception as e:
+        result["error"] = str(e)
+        return result
+    samples = audio_length(notes, params["sample_rate"]) if low_memory else len(audio)
+    result.update(notes=len(notes), audio_seconds=samples / params["sample_rate"],
+                  parse_time=t1 - t0, render_time=t2 - t1, write_time=t3 - t2, wall_time=t3 - t0)
+    if stats is not None:
+        stats.add_time("wav_write", t3 - t2)
+        result["stats"] = stats.to_dict()
+    return result
+
+
+def format_result(result):
+    if "error" in result:
+        return f"FAILED {result['midi']}: {result['error']}"
+    speed = result["audio_seconds"] / result["wall_time"] if result["wall_time"] > 0 else float("inf")
+    return (f"{result['midi']}: {result['notes']} notes, {result['audio_seconds']:.1f}s audio "
+            f"in {result['wall_time']:.2f}s ({result['notes'] / result['wall_time']:.0f} notes/s, "
+            f"{speed:.1f}x real time)")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Convert MIDI files to 8-bit style wav without the GUI")
+    parser.add_argument("paths", nargs="*", default=["dataset"], help="MIDI files or directories (default: dataset)")
+    parser.add_argument("-o", "--output-dir", help="write wavs here, mirroring the input tree (default: next to each .mid)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument("-f", "--force", action="store_true", help="convert even if the wav is newer than the .mid")
+    parser.add_argument("--sample-rate", type=int, default=44100)
+    parser.add_argument("--noise-ratio", type=float, default=0.1)
+    parser.add_argument("--oscillator", choices=["signal", "wavetable"], default="wavetable")
+    parser.add_argument("--stats", metavar="FILE", help="write per-stage timings and counters of every file as JSON")
+    parser.add_argument("--engine", choices=sorted(RENDERERS), default="notes",
+                        help="notes: every note mixed separately; channels: console voices with voice stealing")
+    parser.add_argument("--layout", choices=sorted(VOICE_LAYOUTS), default="nes", help="voices of --engine channels")
+    parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="wav")
+    parser.add_argument("--bits", type=int, choices=[16, 24, 32], help="bit depth (default 16; 32 is float wav; ignored for ogg)")
+    parser.add_argument("--low-memory", action="store_true",
+                        help="render into a scratch file next to the output instead of RAM (notes engine only)")
+    parser.add_argument("--render-workers", type=int, default=1,
+                        help="split each song across this many processes instead of converting files in parallel")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.engine == "channels":
+        params = {"sample_rate": args.sample_rate, "layout": args.layout}
+    else:
+        params = {"sample_rate": args.sample_rate, "noise_ratio": args.noise_ratio, "oscillator": args.oscillator,
+                  "workers": args.render_workers}
+    if args.low_memory and (args.engine != "notes" or args.render_workers > 1):
+        build_parser().error("--low-memory renders with the notes engine in one process")
+    try:
+        # checked before any file is rendered, the writer would only refuse the pair after each render
+        export_bits(args.format, args.bits)
+    except ValueError as e:
+        build_parser().error(str(e))
+    if args.render_workers > 1:
+        # pool workers cannot start their own pools, so files go one at a time
+        args.jobs = 1
+
+    jobs = []
+    skipped = 0
+    for path in args.paths:
+        input_root = path if os.path.isdir(path) else None
+        for midi_path in find_midi_files([path]):
+            wav_path = output_path_for(midi_path, input_root, args.output_dir, args.format)
+            if not args.force and is_up_to_date(midi_path, wav_path):
+                skipped += 1
+                continue
+            jobs.append((midi_path, wav_path, args.engine, params, (args.format, args.bits, args.low_memory),
+                         bool(args.stats)))
+
+    print(f"{len(jobs)} to convert, {skipped} up to date, {args.jobs} workers")
+    if not jobs:
+        return 0
+
+    start = time.perf_counter()
+    results = []
+    if args.jobs > 1:
+        pool = Pool(processes=min(args.jobs, len(jobs)))
+        converted = pool.imap_unordered(convert_file, jobs)
+    else:
+        pool = None
+        converted = map(convert_file, jobs)
+    try:
+        for result in converted:
+            results.append(result)
+            print(format_result(result), flush=True)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    elapsed = time.perf_counter() - start
+
+    done = [r for r in results if "error" not in r]
+    failed = len(results) - len(done)
+    total_notes = sum(r["notes"] for r in done)
+    total_audio = sum(r["audio_seconds"] for r in done)
+    print(f"Converted {len(done)} files ({failed} failed) in {elapsed:.2f}s: "
+          f"{len(done) / elapsed:.2f} files/s, {total_notes / elapsed:.0f} notes/s, "
+          f"{total_audio / elapsed:.1f}x real time")
+
+    if args.stats:
+        total = ConversionStats()
+        for r in done:
+            total.merge(ConversionStats.from_dict(r["stats"]))
+        report = {"files": {r["midi"]: r["stats"] for r in done}, "total": total.to_dict(), "elapsed": elapsed}
+        with open(args.stats, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Stats written to {args.stats}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
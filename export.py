@@ -0,0 +1,115 @@
+import os
+import tempfile
+
+import numpy as np
+
+from blackboard import audio_length, make_note_renderer, mix_notes, note_spans
+
+# samples encoded per write; memory use of an export does not depend on the song length
+EXPORT_CHUNK = 1 << 18
+
+# format -> (libsndfile format, {bit depth: subtype}, default bit depth)
+EXPORT_FORMATS = {
+    'wav': ('WAV', {16: 'PCM_16', 24: 'PCM_24', 32: 'FLOAT'}, 16),
+    'flac': ('FLAC', {16: 'PCM_16', 24: 'PCM_24'}, 16),
+    'ogg': ('OGG', {None: 'VORBIS'}, None),
+}
+# every (format, bit depth) pair that can be written, in the order the GUI cycles through them
+EXPORT_CHOICES = [(fmt, bits) for fmt, (_, subtypes, _) in EXPORT_FORMATS.items() for bits in subtypes]
+
+
+def export_bits(fmt, bits):
+    '''
+    Bit depth an export in fmt will use: the default for None, anything for a format without bit depths
+
+    :raise ValueError: unknown format, or a depth the format cannot be written with
+    '''
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    _, subtypes, default_bits = EXPORT_FORMATS[fmt]
+    bits = default_bits if bits is None or None in subtypes else bits
+    if bits not in subtypes:
+        raise ValueError(f"{fmt} cannot be written with {bits} bits, use one of {sorted(subtypes)}")
+    return bits
+
+
+def _open_writer(path, sample_rate, fmt, bits):
+    import soundfile as sf
+    bits = export_bits(fmt, bits)
+    sf_format, subtypes, _ = EXPORT_FORMATS[fmt]
+    return sf.SoundFile(path, 'w', samplerate=sample_rate, channels=1, format=sf_format, subtype=subtypes[bits])
+
+
+def _write_chunks(samples, path, sample_rate, fmt, bits, gain=1.0, chunk_size=EXPORT_CHUNK, progress=None):
+    # encode to path + '.part' and rename at the end, so a failed or cancelled export leaves nothing behind
+    part_path = path + '.part'
+    try:
+        with _open_writer(part_path, sample_rate, fmt, bits) as writer:
+            total = len(samples)
+            for start in range(0, total, chunk_size):
+                chunk = samples[start:start + chunk_size]
+                if gain != 1.0:
+                    chunk = chunk * np.float32(gain)
+                writer.write(chunk)
+                if progress is not None:
+                    progress(min(start + chunk_size, total) / total)
+        os.replace(part_path, path)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    return path
+
+
+def export_samples(samples, path, sample_rate=44100, fmt='wav', bits=None, chunk_size=EXPORT_CHUNK, progress=None):
+    '''
+    Encode already rendered audio chunk by chunk
+
+    :param samples: float array in [-1, 1] or int16 PCM, may be memory-mapped
+    :param fmt: key of EXPORT_FORMATS ('wav', 'flac', 'ogg')
+    :param bits: 16, 24 or 32 (float WAV); ignored for ogg
+    :param progress: optional callable(fraction done); it may raise ConversionCancelled
+    :return: path
+    '''
+    return _write_chunks(samples, path, sample_rate, fmt, bits, chunk_size=chunk_size, progress=progress)
+
+
+def render_to_file(notes, path, fmt='wav', bits=None, sample_rate=44100, noise_ratio=0.1,
+                   adsr_params=(0.01, 0.1, 0.7, 0.1), oscillator='signal', noise_seed=0,
+                   chunk_size=EXPORT_CHUNK, stats=None, progress=None):
+    """
+    Render a song straight to an audio file without holding it in memory
+
+    The mix is built in a float32 np.memmap scratch file next to the output
+    (same audio as generate_audio(dtype=float32)), its peak is found chunk by
+    chunk, then it is normalized and encoded chunk by chunk.
+
+    param：
+    - notes: NoteTable or list of (start_time, duration, pitch)
+    - path: output file
+    - fmt, bits: as export_samples
+    - other synthesis parameters as generate_audio
+    - progress: optional callable(fraction done); raising ConversionCancelled stops the export
+
+    return：
+    path
+    """
+    if not notes:
+        raise ValueError("No notes to render")
+    length = audio_length(notes, sample_rate)
+    report = (lambda fraction: None) if progress is None else progress
+    with tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(path))) as scratch_file:
+        audio = np.memmap(scratch_file, dtype=np.float32, mode='w+', shape=(length,))
+        render_note = make_note_renderer(sample_rate, noise_ratio, adsr_params, oscillator, noise_seed,
+                                         np.float32, stats)
+        mix_notes(audio, 0, note_spans(notes, sample_rate), render_note, stats,
+                  lambda fraction: report(fraction * 0.8))
+
+        peak = 0.0
+        for start in range(0, length, chunk_size):
+            chunk = audio[start:start + chunk_size]
+            peak = max(peak, float(chunk.max()), -float(chunk.min()))
+        gain = 1 / (peak * 1.4) if peak > 0 else 1.0
+        _write_chunks(audio, path, sample_rate, fmt, bits, gain, chunk_size,
+                      lambda fraction: report(0.8 + fraction * 0.2))
+        del audio
+    return path
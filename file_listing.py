@@ -0,0 +1,134 @@
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+SCAN_BATCH = 1024
+RECHECK_SECONDS = 1.0
+MAX_CACHED_DIRS = 32
+
+
+class DirectoryListing:
+    """
+    Entries of one directory, filled in by the scanner thread
+
+    `entries` is a sorted list of (name, is_dir) tuples and is only ever
+    replaced, never mutated, so the UI thread can read it without locking.
+    `version` increases whenever it changes and `loading` is True until the
+    first scan completed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = []
+        self.version = 0
+        self.loading = True
+        self.error = None
+        self.mtime = None
+        self.midi_count = 0
+        self.checked = 0.0
+        self._views = {}
+
+    def view(self, text="", midi_only=False):
+        '''
+        Entries matching the filter, cached until the listing changes
+
+        :param text: case-insensitive substring the name has to contain
+        :param midi_only: hide everything but directories and .mid files
+        '''
+        key = (self.version, text.lower(), midi_only)
+        view = self._views.get(key)
+        if view is None:
+            view = self.entries
+            if midi_only:
+                view = [e for e in view if e[1] or e[0].lower().endswith(".mid")]
+            if text:
+                needle = text.lower()
+                view = [e for e in view if needle in e[0].lower()]
+            self._views = {key: view}
+        return view
+
+
+class DirectoryCache:
+    """
+    os.scandir based listings, scanned on a background thread
+
+    get() never touches the file system on the calling thread: unknown
+    directories come back empty with `loading` set and fill up in growing
+    snapshots. A listing is rescanned when its directory mtime changes, which
+    the scanner checks at most every RECHECK_SECONDS while it is in use.
+    """
+
+    def __init__(self, max_dirs=MAX_CACHED_DIRS):
+        self.max_dirs = max_dirs
+        self.listings = OrderedDict()
+        self.requests = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="directory-scanner", daemon=True)
+        self._thread.start()
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        with self._lock:
+            listing = self.listings.get(path)
+            if listing is None:
+                listing = self.listings[path] = DirectoryListing(path)
+                while len(self.listings) > self.max_dirs:
+                    self.listings.popitem(last=False)
+                self.requests.put(listing)
+            else:
+                self.listings.move_to_end(path)
+                if not listing.loading and time.monotonic() - listing.checked > RECHECK_SECONDS:
+                    listing.checked = time.monotonic()
+                    self.requests.put(listing)
+        return listing
+
+    def invalidate(self, path=None):
+        '''
+        Drop one cached listing, or all of them
+        '''
+        with self._lock:
+            if path is None:
+                self.listings.clear()
+            else:
+                self.listings.pop(os.path.abspath(path), None)
+
+    def _run(self):
+        while True:
+            listing = self.requests.get()
+            try:
+                mtime = os.stat(listing.path).st_mtime_ns
+                if mtime != listing.mtime:
+                    self._scan(listing, mtime)
+            except OSError as e:
+                listing.error = e
+                listing.entries = []
+                listing.version += 1
+            listing.loading = False
+            listing.checked = time.monotonic()
+
+    def _scan(self, listing, mtime):
+        # a rescan keeps showing the old entries until the new ones are complete
+        publish = listing.loading
+        entries = []
+        # a first scan shows partial snapshots, each one taken when the count has doubled, so sorting
+        # them costs a small multiple of the final sort however large the directory
+        next_publish = SCAN_BATCH
+        with os.scandir(listing.path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                entries.append((entry.name, is_dir))
+                if publish and len(entries) >= next_publish:
+                    listing.entries = sorted(entries)
+                    listing.version += 1
+                    next_publish *= 2
+        entries.sort()
+        listing.entries = entries
+        listing.midi_count = sum(1 for name, is_dir in listing.entries if not is_dir and name.lower().endswith(".mid"))
+        listing.mtime = mtime
+        listing.error = None
+        listing.version += 1
@@ -0,0 +1,420 @@
+import argparse
+import threading
+import time
+
+import numpy as np
+
+from blackboard import DEFAULT_WAVE_RATIOS, get_noise_bank, get_wavetables, limit_block, pitch_to_freq
+
+# 128 frames are 2.9 ms at 44.1 kHz; with a low-latency device that keeps note-to-sound under 10 ms
+BLOCK_SIZE = 128
+MAX_VOICES = 16
+EVENT_QUEUE_SIZE = 1024
+NOTE_OFF, NOTE_ON, ALL_NOTES_OFF = 0, 1, 2
+# envelope stages of a voice
+IDLE, ATTACK, DECAY, SUSTAIN, RELEASE = range(5)
+
+
+class EventRing:
+    """
+    Bounded single-producer / single-consumer queue of note events
+
+    The MIDI thread only advances `write` and the audio callback only
+    advances `read`, so neither takes a lock; slots are preallocated and
+    events arriving while the ring is full are dropped and counted.
+    """
+
+    def __init__(self, size=EVENT_QUEUE_SIZE):
+        self.size = size
+        self.kinds = [0] * size
+        self.notes = [0] * size
+        self.velocities = [0] * size
+        self.write = 0
+        self.read = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self.write - self.read
+
+    def push(self, kind, note=0, velocity=0):
+        if self.write - self.read >= self.size:
+            self.dropped += 1
+            return False
+        slot = self.write % self.size
+        self.kinds[slot], self.notes[slot], self.velocities[slot] = kind, note, velocity
+        self.write += 1
+        return True
+
+    def pop(self):
+        '''
+        Oldest event as (kind, note, velocity), or None when empty
+        '''
+        if self.read == self.write:
+            return None
+        slot = self.read % self.size
+        event = self.kinds[slot], self.notes[slot], self.velocities[slot]
+        self.read += 1
+        return event
+
+
+class LiveSynth:
+    """
+    Real-time voices for note events from a MIDI input, rendered block by block
+
+    Every voice is the same square + triangle wavetable plus noise as
+    make_note_renderer(oscillator='wavetable'), shaped by the ADSR
+    parameters. Every voice is processed together as (voices x frames)
+    arrays allocated once, an idle one with a zero envelope, so a callback
+    costs the same NumPy calls however many notes sound and allocates no
+    arrays. Events are applied at the start of the next
+    block; the envelope runs at block rate and is interpolated across it.
+    When every voice is busy the oldest one is stolen. limit_block keeps
+    the output below 1 / 1.4 like the offline renders.
+
+    `counters` holds callbacks, underflows (reported by the device),
+    late_callbacks (a block took longer to compute than to play),
+    voice_steals and dropped_events; `max_callback_seconds` the slowest block.
+    """
+
+    def __init__(self, sample_rate=44100, block_size=BLOCK_SIZE, voices=MAX_VOICES, noise_ratio=0.1,
+                 adsr_params=(0.01, 0.1, 0.7, 0.1), wave_ratios=None, gain=0.5, noise_seed=0):
+        self.sample_rate = sample_rate
+        self.block_size = block_size
+        self.adsr_params = adsr_params
+        self.events = EventRing()
+        ratios = {**DEFAULT_WAVE_RATIOS, **(wave_ratios or {})}
+        tables = get_wavetables()
+        self.table = 0.6 * (tables['square'] * ratios['square'] + tables['triangle'] * ratios['triangle'])
+        self.noise = get_noise_bank(sample_rate, noise_seed) * noise_ratio
+        self.limiter = {'gain': gain, 'current': gain}
+
+        # per-voice state
+        self.stage = np.full(voices, IDLE, dtype=np.int8)
+        self.note = np.full(voices, -1, dtype=np.int16)
+        self.step = np.zeros(voices)
+        self.phase = np.zeros(voices)
+        self.noise_offset = np.zeros(voices, dtype=np.int64)
+        self.level = np.zeros(voices)
+        self.release_rate = np.zeros(voices)
+        self.velocity = np.zeros(voices)
+        self.started = np.zeros(voices, dtype=np.int64)
+        self._note_count = 0
+
+        # scratch for one block, reused by every callback
+        self._ramp = np.arange(block_size, dtype=np.float64)
+        self._offsets = np.arange(block_size, dtype=np.int64)
+        self._fraction = self._ramp / block_size
+        self._phases = np.empty((voices, block_size))
+        self._index = np.empty((voices, block_size), dtype=np.int64)
+        self._wave = np.empty((voices, block_size))
+        self._noise = np.empty((voices, block_size))
+        self._envelope = np.empty((voices, block_size))
+        self._block = np.zeros(block_size)
+        self._gain = np.empty(block_size)
+        self._start_level = np.empty(voices)
+        self._delta = np.empty(voices)
+        self._in_stage = np.empty(voices, dtype=bool)
+        self._done = np.empty(voices, dtype=bool)
+
+        self.counters = {'callbacks': 0, 'underflows': 0, 'late_callbacks': 0, 'voice_steals': 0,
+                         'dropped_events': 0}
+        self.max_callback_seconds = 0.0
+        self.stream = None
+        self.port = None
+
+    # --- input side, any thread ---
+
+    def send(self, message):
+        '''
+        Queue a mido message; note_on / note_off and all-notes-off (CC 123) are used, the rest ignored.
+        Suitable as the callback of a mido input port.
+        '''
+        if message.type == 'note_on' and message.velocity > 0:
+            self.events.push(NOTE_ON, message.note, message.velocity)
+        elif message.type in ('note_on', 'note_off'):
+            self.events.push(NOTE_OFF, message.note)
+        elif message.type == 'control_change' and message.control == 123:
+            self.events.push(ALL_NOTES_OFF)
+
+    def open_port(self, name=None, virtual=False):
+        '''
+        Listen to a MIDI input; virtual=True creates a port other programs can play into
+        '''
+        import mido
+        self.port = mido.open_input(name, virtual=virtual, callback=self.send)
+        return self.port
+
+    # --- audio side, the device callback ---
+
+    def _apply_events(self):
+        while True:
+            event = self.events.pop()
+            if event is None:
+                break
+            kind, note, velocity = event
+            if kind == NOTE_ON:
+                self._note_on(note, velocity)
+            elif kind == NOTE_OFF:
+                self._release((self.note == note) & (self.stage != RELEASE) & (self.stage != IDLE))
+            else:
+                self._release(self.stage != IDLE)
+
+    def _note_on(self, note, velocity):
+        same = np.nonzero((self.note == note) & (self.stage != IDLE))[0]
+        idle = np.nonzero(self.stage == IDLE)[0]
+        if len(same):
+            voice = same[0]
+        elif len(idle):
+            voice = idle[0]
+        else:
+            voice = int(np.argmin(self.started))
+            self.counters['voice_steals'] += 1
+        self.stage[voice] = ATTACK
+        self.note[voice] = note
+        self.step[voice] = pitch_to_freq(note) / self.sample_rate
+        self.phase[voice] = 0.0
+        self.noise_offset[voice] = (note * 104729 + self._note_count * 7919) % len(self.noise)
+        self.level[voice] = 0.0
+        self.velocity[voice] = velocity / 127
+        self._note_count += 1
+        self.started[voice] = self._note_count
+
+    def _release(self, voices):
+        release_samples = max(1.0, self.adsr_params[3] * self.sample_rate)
+        self.stage[voices] = RELEASE
+        self.release_rate[voices] = self.level[voices] / release_samples
+
+    def _advance_envelope(self, frames):
+        attack, decay, sustain, _ = self.adsr_params
+        level, stage = self.level, self.stage
+        in_stage, done = self._in_stage, self._done
+        attack_rate = frames / max(1.0, attack * self.sample_rate)
+        decay_rate = frames * (1 - sustain) / max(1.0, decay * self.sample_rate)
+
+        # release and decay go first so a voice leaving the attack this block decays from the next one
+        np.equal(stage, RELEASE, out=in_stage)
+        np.multiply(self.release_rate, frames, out=self._delta)
+        np.subtract(level, self._delta, out=level, where=in_stage)
+        np.less_equal(level, 0.0, out=done)
+        done &= in_stage
+        np.copyto(level, 0.0, where=done)
+        np.copyto(stage, IDLE, where=done)
+        np.copyto(self.note, -1, where=done)
+
+        np.equal(stage, DECAY, out=in_stage)
+        np.subtract(level, decay_rate, out=level, where=in_stage)
+        np.less_equal(level, sustain, out=done)
+        done &= in_stage
+        np.copyto(level, sustain, where=done)
+        np.copyto(stage, SUSTAIN, where=done)
+
+        np.equal(stage, ATTACK, out=in_stage)
+        np.add(level, attack_rate, out=level, where=in_stage)
+        np.greater_equal(level, 1.0, out=done)
+        done &= in_stage
+        np.copyto(level, 1.0, where=done)
+        np.copyto(stage, DECAY, where=done)
+
+    def render(self, frames=None):
+        '''
+        Next block of audio after applying the queued events
+
+        :param frames: samples to render, at most block_size
+        :return: float64 view of a reused buffer, valid until the next call
+        '''
+        frames = self.block_size if frames is None else min(frames, self.block_size)
+        self._apply_events()
+        block = self._block[:frames]
+        if not self.stage.any():
+            block.fill(0)
+            return limit_block(block, self.limiter, scratch=self._gain)
+        phases = self._phases[:, :frames]
+        index = self._index[:, :frames]
+        wave = self._wave[:, :frames]
+        noise = self._noise[:, :frames]
+        envelope = self._envelope[:, :frames]
+        ramp = self._ramp[:frames]
+
+        # oscillator: phase accumulator reading the table, continuous across blocks
+        np.multiply(self.step[:, None], ramp, out=phases)
+        phases += self.phase[:, None]
+        phases *= len(self.table)
+        np.copyto(index, phases, casting='unsafe')
+        index &= len(self.table) - 1
+        np.take(self.table, index, out=wave)
+        np.multiply(self.step, frames, out=self._delta)
+        self.phase += self._delta
+        self.phase %= 1.0
+
+        # noise: each voice reads the shared bank from its own offset
+        np.add(self.noise_offset[:, None], self._offsets[:frames], out=index)
+        index %= len(self.noise)
+        np.take(self.noise, index, out=noise)
+        self.noise_offset += frames
+        wave += noise
+
+        # envelope: block-rate ADSR, linearly interpolated over the block; idle voices stay at zero
+        start_level = self._start_level
+        np.copyto(start_level, self.level)
+        self._advance_envelope(frames)
+        np.subtract(self.level, start_level, out=self._delta)
+        np.multiply(self._delta[:, None], self._fraction[:frames], out=envelope)
+        envelope += start_level[:, None]
+        envelope *= self.velocity[:, None]
+        wave *= envelope
+        wave.sum(axis=0, out=block)
+        return limit_block(block, self.limiter, scratch=self._gain)
+
+    def _callback(self, outdata, frames, time_info, status):
+        started = time.perf_counter()
+        self.counters['callbacks'] += 1
+        if status and status.output_underflow:
+            self.counters['underflows'] += 1
+        # the device may ask for more than one block; render them back to back
+        for offset in range(0, frames, self.block_size):
+            outdata[offset:offset + self.block_size, 0] = self.render(frames - offset)
+        elapsed = time.perf_counter() - started
+        self.max_callback_seconds = max(self.max_callback_seconds, elapsed)
+        if elapsed > frames / self.sample_rate:
+            self.counters['late_callbacks'] += 1
+        self.counters['dropped_events'] = self.events.dropped
+
+    def start(self, device=None, latency='low', null=False):
+        '''
+        Open the output stream: a sounddevice device, or with null=True a
+        NullOutputStream that consumes blocks in real time without audio hardware
+        '''
+        if null:
+            self.stream = NullOutputStream(self.sample_rate, self.block_size, self._callback)
+        else:
+            import sounddevice as sd
+            self.stream = sd.OutputStream(samplerate=self.sample_rate, blocksize=self.block_size, channels=1,
+                                          dtype='float32', latency=latency, device=device, callback=self._callback)
+        self.stream.start()
+        return self.stream
+
+    @property
+    def latency(self):
+        '''
+        Seconds from an event to its sound: device output latency plus up to one block of waiting
+        '''
+        if self.stream is None:
+            return None
+        return self.stream.latency + self.block_size / self.sample_rate
+
+    def stop(self):
+        if self.port is not None:
+            self.port.close()
+            self.port = None
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+
+
+class NullOutputStream:
+    """
+    Stands in for sounddevice.OutputStream where there is no audio device
+
+    A thread calls the callback once per block at the real-time pace and
+    throws the audio away. When it wakes up more than a block late it sets
+    output_underflow, as a device would report an xrun.
+    """
+
+    class Status:
+        def __init__(self, output_underflow=False):
+            self.output_underflow = output_underflow
+
+        def __bool__(self):
+            return self.output_underflow
+
+    def __init__(self, sample_rate, block_size, callback):
+        self.block_size = block_size
+        self.period = block_size / sample_rate
+        self.callback = callback
+        self.latency = self.period
+        self.buffer = np.zeros((block_size, 1), dtype=np.float32)
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="null-audio", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        deadline = time.perf_counter()
+        while self._running:
+            late = time.perf_counter() - deadline > self.period
+            if late:
+                deadline = time.perf_counter()
+            self.callback(self.buffer, self.block_size, None, self.Status(late))
+            deadline += self.period
+            delay = deadline - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+
+    def close(self):
+        pass
+
+
+def play_demo(synth, seconds=2.0):
+    # an arpeggio sent through the same path as MIDI input, for trying the engine without a keyboard
+    import mido
+    notes = [60, 64, 67, 72, 76, 79, 84]
+    end = time.perf_counter() + seconds
+    i = 0
+    while time.perf_counter() < end:
+        note = notes[i % len(notes)]
+        synth.send(mido.Message('note_on', note=note, velocity=100))
+        time.sleep(0.08)
+        synth.send(mido.Message('note_off', note=note))
+        i += 1
+    synth.send(mido.Message('control_change', control=123))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Play a MIDI input through the 8-bit voices in real time")
+    parser.add_argument("--port", help="MIDI input to open (default: the system default)")
+    parser.add_argument("--virtual", metavar="NAME", help="create a virtual MIDI input with this name instead")
+    parser.add_argument("--list", action="store_true", help="list MIDI inputs and exit")
+    parser.add_argument("--device", help="sounddevice output device")
+    parser.add_argument("--null", action="store_true", help="no audio hardware: consume blocks on a timer")
+    parser.add_argument("--demo", type=float, metavar="SECONDS",
+                        help="play an arpeggio instead of opening a MIDI input, then print the counters")
+    parser.add_argument("--block-size", type=int, default=BLOCK_SIZE)
+    parser.add_argument("--sample-rate", type=int, default=44100)
+    parser.add_argument("--noise-ratio", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    if args.list:
+        import mido
+        print("\n".join(mido.get_input_names()))
+        return 0
+    synth = LiveSynth(args.sample_rate, args.block_size, noise_ratio=args.noise_ratio)
+    synth.start(args.device, null=args.null)
+    print(f"Output latency {synth.latency * 1000:.1f} ms ({args.block_size} frames per block)")
+    try:
+        if args.demo:
+            play_demo(synth, args.demo)
+        else:
+            synth.open_port(args.virtual or args.port, virtual=bool(args.virtual))
+            print("Listening, Ctrl+C to stop")
+            while True:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        synth.stop()
+        print(", ".join(f"{name} {n}" for name, n in synth.counters.items()),
+              f"| slowest block {synth.max_callback_seconds * 1000:.2f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
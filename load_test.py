@@ -0,0 +1,154 @@
+import argparse
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from urllib.parse import urlencode
+
+import numpy as np
+
+from convert import find_midi_files
+
+# noise ratios cycled through by the requests; each one is a separate cache entry per song
+NOISE_RATIOS = (0.05, 0.1, 0.15, 0.2)
+
+
+def start_local_service(workers, queue_size, timeout, cache_dir):
+    '''
+    Run a ConversionService in this process on a free port
+
+    :return: (base url, server, service)
+    '''
+    from conversion_service import ConversionService, make_server
+    service = ConversionService(workers, queue_size, timeout, cache_dir)
+    service.warm_up()
+    server = make_server(service, port=0, quiet=True)
+    threading.Thread(target=server.serve_forever, name="conversion-service", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}", server, service
+
+
+def post_midi(url, midi_bytes, params, timeout):
+    '''
+    :return: (HTTP status, seconds, bytes received, X-Cache header)
+    '''
+    request = urllib.request.Request(f"{url}/convert?{urlencode(params)}", data=midi_bytes, method="POST",
+                                     headers={"Content-Type": "audio/midi"})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            body = response.read()
+            return response.status, time.perf_counter() - start, len(body), response.headers.get("X-Cache")
+    except urllib.error.HTTPError as e:
+        e.read()
+        return e.code, time.perf_counter() - start, 0, None
+
+
+def run_load(url, songs, requests, concurrency, variants, timeout):
+    '''
+    Send `requests` conversions from `concurrency` client threads
+
+    :param songs: list of MIDI file contents
+    :param variants: how many noise ratios to mix in; 1 repeats the same conversions (cache hits)
+    :return: list of (status, seconds, bytes, cache) per request
+    '''
+    results = []
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def client():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            params = {"noise_ratio": NOISE_RATIOS[(i // len(songs)) % variants], "timeout": timeout}
+            result = post_midi(url, songs[i % len(songs)], params, timeout + 5)
+            with lock:
+                results.append(result)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def summarize(results, elapsed):
+    ok = [r for r in results if r[0] == 200]
+    statuses = {}
+    for status, *_ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    report = {"requests": len(results), "elapsed": elapsed, "throughput": len(results) / elapsed,
+              "statuses": statuses, "cache_hits": sum(1 for r in ok if r[3] == "hit"),
+              "megabytes": sum(r[2] for r in ok) / 1e6}
+    if ok:
+        seconds = np.array([r[1] for r in ok])
+        report["latency"] = {"mean": float(seconds.mean()), "p50": float(np.percentile(seconds, 50)),
+                             "p95": float(np.percentile(seconds, 95)), "p99": float(np.percentile(seconds, 99)),
+                             "max": float(seconds.max())}
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Drive the conversion service with concurrent requests")
+    parser.add_argument("paths", nargs="*", default=["dataset"], help="MIDI files or directories to send")
+    parser.add_argument("--url", help="running service (default: start one in this process)")
+    parser.add_argument("-n", "--requests", type=int, default=40)
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="client threads")
+    parser.add_argument("--variants", type=int, default=2, choices=range(1, len(NOISE_RATIOS) + 1),
+                        help="distinct parameter sets per song; fewer means more cache hits")
+    parser.add_argument("--timeout", type=float, default=60.0, help="per-request timeout sent to the service")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1, help="workers of the local service")
+    parser.add_argument("--queue-size", type=int, default=16, help="queue of the local service")
+    parser.add_argument("--cache-dir", help="cache of the local service (default: a fresh temporary directory)")
+    parser.add_argument("-o", "--output", help="write the report as JSON")
+    args = parser.parse_args(argv)
+
+    songs = []
+    for path in find_midi_files(args.paths):
+        with open(path, "rb") as f:
+            songs.append(f.read())
+    if not songs:
+        parser.error("no MIDI files found")
+
+    server = service = scratch = None
+    url = args.url
+    if url is None:
+        import tempfile
+        scratch = tempfile.TemporaryDirectory()
+        url, server, service = start_local_service(args.workers, args.queue_size, args.timeout,
+                                                   args.cache_dir or scratch.name)
+    try:
+        start = time.perf_counter()
+        results = run_load(url.rstrip("/"), songs, args.requests, args.concurrency, args.variants, args.timeout)
+        report = summarize(results, time.perf_counter() - start)
+        with urllib.request.urlopen(f"{url.rstrip('/')}/metrics") as response:
+            report["service"] = json.load(response)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+            service.close()
+        if scratch is not None:
+            scratch.cleanup()
+
+    print(f"{report['requests']} requests in {report['elapsed']:.2f}s ({report['throughput']:.2f}/s), "
+          f"statuses {report['statuses']}, {report['cache_hits']} cache hits")
+    if "latency" in report:
+        latency = report["latency"]
+        print(f"latency p50 {latency['p50'] * 1000:.0f} ms, p95 {latency['p95'] * 1000:.0f} ms, "
+              f"p99 {latency['p99'] * 1000:.0f} ms, max {latency['max'] * 1000:.0f} ms")
+    counters = report["service"]["counters"]
+    print("service: " + ", ".join(f"{name} {n}" for name, n in counters.items()))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+    return 0 if all(r[0] == 200 for r in results) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
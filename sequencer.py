@@ -0,0 +1,342 @@
+import time
+from collections import deque
+
+import numpy as np
+import pygame
+
+from blackboard import to_pcm16
+
+
+def make_sound(pcm):
+    '''
+    pygame Sound from mono int16 PCM, written straight into the mixer's buffer
+    (duplicated to every mixer channel instead of stacking a stereo copy)
+    '''
+    channels = pygame.mixer.get_init()[2]
+    sound = pygame.mixer.Sound(buffer=bytes(len(pcm) * channels * 2))
+    samples = pygame.sndarray.samples(sound)
+    samples[:] = pcm[:, None] if channels > 1 else pcm
+    del samples
+    return sound
+
+
+def step_samples_for(bps, sample_rate=44100):
+    return int(round(sample_rate / bps))
+
+
+class PatternGrid:
+    """
+    Step pattern stored as one bit mask per column, bit r set when row r is on
+
+    16 rows fit a uint16, so a pattern costs two bytes per column whatever
+    its length. The mask array grows by doubling, so dragging the column
+    count does not rebuild anything.
+    """
+
+    def __init__(self, rows=16, columns=16):
+        if rows > 16:
+            raise ValueError("PatternGrid holds at most 16 rows")
+        self.rows = rows
+        self.columns = 0
+        self._masks = np.zeros(0, dtype=np.uint16)
+        self.resize(columns)
+
+    @classmethod
+    def from_rows(cls, rows):
+        '''
+        Build from rows x columns of 0/1, the layout the grid used to have
+        '''
+        grid = cls(len(rows), len(rows[0]) if rows else 0)
+        for r, row in enumerate(rows):
+            grid._masks[:len(row)] |= np.asarray(row, dtype=bool).astype(np.uint16) << r
+        return grid
+
+    @property
+    def masks(self):
+        return self._masks[:self.columns]
+
+    def __getitem__(self, cell):
+        row, col = cell
+        return (int(self._masks[col]) >> row) & 1
+
+    def __setitem__(self, cell, value):
+        row, col = cell
+        if value:
+            self._masks[col] |= 1 << row
+        else:
+            self._masks[col] &= ~np.uint16(1 << row)
+
+    def toggle(self, row, col):
+        self._masks[col] ^= 1 << row
+
+    def resize(self, columns):
+        '''
+        Change the column count; columns cut off are cleared, as the list grid used to drop them
+        '''
+        if columns > len(self._masks):
+            masks = np.zeros(max(columns, 2 * len(self._masks), 16), dtype=np.uint16)
+            masks[:self.columns] = self.masks
+            self._masks = masks
+        elif columns < self.columns:
+            self._masks[columns:self.columns] = 0
+        self.columns = columns
+
+    def clear(self):
+        self._masks[:] = 0
+
+    def row_bits(self, masks):
+        '''
+        Unpack masks into a (len(masks), rows) float32 matrix of 0/1
+        '''
+        shifts = np.arange(self.rows, dtype=np.uint16)
+        return ((masks[:, None] >> shifts) & 1).astype(np.float32)
+
+
+def wave_pieces(waves, step_samples):
+    '''
+    Cut every row's wave into step-long pieces; piece j is what a cell adds j steps after its own column
+
+    :return: float32 array of shape (pieces, rows, step_samples)
+    '''
+    pieces = max(1, -(-max(len(wave) for wave in waves) // step_samples))
+    table = np.zeros((len(waves), pieces * step_samples), dtype=np.float32)
+    for row, wave in enumerate(waves):
+        table[row, :len(wave)] = wave
+    return table.reshape(len(waves), pieces, step_samples).transpose(1, 0, 2)
+
+
+def render_pattern(grid, waves, step_samples, columns=None, start=0, count=None):
+    '''
+    Mix the pattern into one seamless loop, or a window of it
+
+    Every active cell starts its row's wave exactly at column * step_samples;
+    tails running past the end wrap to the start so the loop repeats cleanly.
+    With the waves cut into step-long pieces, the audio of all columns is a
+    (columns x rows) 0/1 matrix times a (rows x step) matrix per piece, so
+    the loop is rendered in one pass. Only columns holding a note take part.
+
+    :param grid: PatternGrid
+    :param waves: one float sample array per row
+    :param columns: number of columns in the loop (default: the grid width)
+    :param start: first column to render, taken modulo the loop
+    :param count: columns to render (default: the whole loop)
+    :return: int16 PCM of count * step_samples samples
+    '''
+    columns = grid.columns if columns is None else columns
+    count = columns if count is None else count
+    out = np.zeros((count, step_samples), dtype=np.float32)
+    if columns and count:
+        masks = grid.masks[:columns]
+        index = start + np.arange(count)
+        for j, piece in enumerate(wave_pieces(waves, step_samples)):
+            # the cells sounding their j-th piece in a column started j columns earlier
+            shifted = masks[(index - j) % columns]
+            active = np.nonzero(shifted)[0]
+            if len(active):
+                out[active] += grid.row_bits(shifted[active]) @ piece
+    loop = out.reshape(-1)
+    np.clip(loop, -1.0, 1.0, out=loop)
+    return to_pcm16(loop)
+
+
+class PatternPlayer:
+    """
+    Streams the pattern as short Sounds queued on one channel and reports where it is
+
+    Each chunk is rendered from the live grid just before it is queued, so
+    edits are heard from the next chunk on and a pattern of thousands of
+    columns is never rendered as a whole. Steps are sample-accurate inside a
+    chunk and chunks follow each other without a gap, so the playhead is
+    derived from the time each chunk was scheduled to start rather than
+    from UI polling.
+    """
+
+    def __init__(self, sample_rate=44100, channel_id=0, chunk_seconds=0.25):
+        self.sample_rate = sample_rate
+        # a reserved channel, so Sound.play() and get_busy() elsewhere do not collide with the loop
+        pygame.mixer.set_reserved(channel_id + 1)
+        self.channel = pygame.mixer.Channel(channel_id)
+        self.chunk_seconds = chunk_seconds
+        self.render = None
+        self.columns = 0
+        self.step_samples = 0
+        self.playing = False
+        # (first column, column count, step samples, start time) of the chunks handed to the mixer
+        self._scheduled = deque()
+        self._next_column = 0
+        self._paused_step = None
+
+    @property
+    def active(self):
+        '''
+        True while playing or paused somewhere in the pattern
+        '''
+        return self.playing or self._paused_step is not None
+
+    def current_step(self):
+        if not self.playing:
+            return self._paused_step
+        now = time.perf_counter()
+        while len(self._scheduled) > 1 and self._scheduled[1][3] <= now:
+            self._scheduled.popleft()
+        first, count, step_samples, started = self._scheduled[0]
+        offset = int((now - started) * self.sample_rate) // step_samples
+        return (first + min(max(offset, 0), count - 1)) % self.columns
+
+    def play(self, render, columns, step_samples, step=None):
+        '''
+        Start looping, from the given step or from where it was paused
+
+        :param render: callable(start_column, count, step_samples) -> int16 PCM, e.g. render_pattern on the grid
+        '''
+        self.render = render
+        self.columns, self.step_samples = columns, step_samples
+        if step is None:
+            step = self._paused_step or 0
+        self._start(step)
+
+    def refresh(self, columns, step_samples):
+        '''
+        Pick up an edit, a new column count or tempo; the chunk waiting in the queue is rendered again
+        '''
+        self.columns, self.step_samples = columns, step_samples
+        if self._paused_step is not None:
+            self._paused_step = min(self._paused_step, columns - 1)
+        if not self.playing:
+            return
+        if self.channel.get_queue() is not None and len(self._scheduled) > 1:
+            # not started yet, so replace it (a channel keeps only the latest queued Sound)
+            first, _, _, started = self._scheduled.pop()
+            self._next_column = first % columns
+            self._queue_chunk(started)
+        else:
+            self._next_column %= columns
+
+    def update(self):
+        '''
+        Keep one chunk queued behind the playing one; call once per frame
+        '''
+        if not self.playing:
+            return
+        if not self.channel.get_busy():
+            # the queue ran dry during a long frame: carry on from where the playhead should be
+            self._start(self.current_step())
+        elif self.channel.get_queue() is None:
+            first, count, step_samples, started = self._scheduled[-1]
+            self._queue_chunk(started + count * step_samples / self.sample_rate)
+
+    def _start(self, step):
+        self.channel.stop()
+        self._scheduled.clear()
+        self._paused_step = None
+        self.playing = bool(self.columns and self.step_samples)
+        if not self.playing:
+            return
+        self._next_column = step % self.columns
+        self._queue_chunk(time.perf_counter(), play=True)
+        self.update()
+
+    def _queue_chunk(self, started, play=False):
+        count = max(1, -(-int(self.chunk_seconds * self.sample_rate) // self.step_samples))
+        first = self._next_column
+        sound = make_sound(self.render(first, count, self.step_samples))
+        if play:
+            self.channel.play(sound)
+        else:
+            self.channel.queue(sound)
+        self._scheduled.append((first, count, self.step_samples, started))
+        self._next_column = (first + count) % self.columns
+
+    def stop(self):
+        '''
+        Pause, remembering the step for the next play()
+        '''
+        if self.playing:
+            self._paused_step = self.current_step()
+        self.channel.stop()
+        self._scheduled.clear()
+        self.playing = False
+
+    def reset(self):
+        self.stop()
+        self._paused_step = None
+
+
+class SongPlayer:
+    """
+    Plays a long buffer as a chain of short Sounds queued on one channel
+
+    The UI calls update() every frame to queue the next chunk. Because the
+    chunks are cut from whatever buffer is current, swap() replaces the
+    audio (a refined render, a remix) at the next chunk boundary, on the
+    same sample, without stopping playback. A buffer still being rendered
+    plays up to its `ready` count and waits there.
+    """
+
+    def __init__(self, sample_rate=44100, channel_id=1, chunk_seconds=0.5):
+        self.sample_rate = sample_rate
+        pygame.mixer.set_reserved(channel_id + 1)
+        self.channel = pygame.mixer.Channel(channel_id)
+        self.chunk = int(sample_rate * chunk_seconds)
+        self.pcm = None
+        self.ready = None
+        self.next_sample = 0
+        self.playing = False
+        self._started = 0.0
+
+    def position(self):
+        '''
+        Sample being heard, estimated from the time playback started
+        '''
+        if not self.playing:
+            return 0
+        return min(int((time.perf_counter() - self._started) * self.sample_rate), self.next_sample)
+
+    def play(self, pcm, position=0, ready=None):
+        '''
+        :param ready: optional callable() -> samples of pcm rendered so far, for a buffer still being filled
+        '''
+        self.channel.stop()
+        self.pcm = pcm
+        self.ready = ready
+        self.next_sample = position
+        self.playing = True
+        self.update()
+
+    def swap(self, pcm, ready=None):
+        '''
+        Continue with another buffer of the same song from the next chunk on
+        '''
+        self.pcm = pcm
+        self.ready = ready
+
+    def update(self):
+        '''
+        Keep one chunk queued behind the playing one; call once per frame
+        '''
+        if not self.playing:
+            return
+        if self.next_sample >= len(self.pcm):
+            # everything is queued: done once the channel runs dry
+            self.playing = self.channel.get_busy()
+            return
+        if not self.channel.get_busy():
+            if not self._chunk_ready():
+                return
+            # starting, or the render fell behind and the channel ran dry: the clock restarts here
+            self._started = time.perf_counter() - self.next_sample / self.sample_rate
+            self.channel.play(self._next_chunk())
+        if self.channel.get_queue() is None and self.next_sample < len(self.pcm) and self._chunk_ready():
+            self.channel.queue(self._next_chunk())
+
+    def _chunk_ready(self):
+        return self.ready is None or self.ready() >= min(self.next_sample + self.chunk, len(self.pcm))
+
+    def _next_chunk(self):
+        chunk = self.pcm[self.next_sample:self.next_sample + self.chunk]
+        self.next_sample += len(chunk)
+        return make_sound(chunk)
+
+    def stop(self):
+        self.channel.stop()
+        self.playing = False
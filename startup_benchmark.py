@@ -0,0 +1,91 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from benchmark import DEFAULT_THRESHOLD, TIME_SLACK_SECONDS
+
+# modules the GUI must not import before its first frame
+HEAVY_MODULES = ("scipy", "tkinter", "distutils", "soundfile", "mido")
+
+# runs in a fresh interpreter: import the GUI, draw one frame, wait for the deferred background
+CHILD = r'''
+import json, sys, time
+start = time.perf_counter()
+import Try_project as app
+imported = time.perf_counter()
+app.present_frame()
+first_frame = time.perf_counter()
+while app.background_image is None and time.perf_counter() - first_frame < 10:
+    time.sleep(0.001)
+background = time.perf_counter()
+print(json.dumps({
+    "import": imported - start,
+    "first_frame": first_frame - start,
+    "background": background - start,
+    "heavy_modules": sorted(name for name in HEAVY_MODULES if name in sys.modules),
+}))
+'''
+
+
+def measure(runs, headless):
+    '''
+    Start the GUI `runs` times in fresh interpreters
+
+    :return: dict metric -> list of seconds, plus the heavy modules seen loaded at the first frame
+    '''
+    env = dict(os.environ)
+    if headless:
+        env.update(SDL_VIDEODRIVER="dummy", SDL_AUDIODRIVER="dummy")
+    here = os.path.dirname(os.path.abspath(__file__))
+    samples = {"import": [], "first_frame": [], "background": []}
+    heavy = set()
+    for _ in range(runs):
+        code = f"HEAVY_MODULES = {HEAVY_MODULES!r}\n" + CHILD
+        output = subprocess.run([sys.executable, "-c", code], cwd=here, env=env, check=True,
+                                capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        for metric in samples:
+            samples[metric].append(result[metric])
+        heavy.update(result["heavy_modules"])
+    return samples, sorted(heavy)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure how fast Try_project.py shows its first frame")
+    parser.add_argument("--runs", type=int, default=5, help="cold starts, the median is reported")
+    parser.add_argument("--headless", action="store_true", help="use SDL's dummy video and audio drivers")
+    parser.add_argument("-o", "--output", default="startup_results.json", help="where to write the JSON results")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="relative slowdown counted as a regression")
+    args = parser.parse_args(argv)
+
+    samples, heavy = measure(args.runs, args.headless)
+    results = {name: statistics.median(values) for name, values in samples.items()}
+    results["heavy_modules"] = heavy
+    for name in samples:
+        print(f"{name:12} {results[name] * 1000:8.1f} ms (median of {args.runs})")
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    failed = False
+    if heavy:
+        print("REGRESSION loaded before the first frame:", ", ".join(heavy))
+        failed = True
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for name in ("import", "first_frame"):
+            old, new = baseline[name], results[name]
+            if new > old * (1 + args.threshold) + TIME_SLACK_SECONDS:
+                print(f"REGRESSION {name}: {old * 1000:.1f} ms -> {new * 1000:.1f} ms")
+                failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,141 @@
+import numpy as np
+
+# samples per entry of the finest level; each coarser level halves the count
+PEAK_BLOCK = 64
+
+
+class PeakPyramid:
+    """
+    Multi-resolution min/max index of an audio buffer, for drawing waveforms
+
+    Level 0 holds the min and max of every PEAK_BLOCK samples, level n of
+    every PEAK_BLOCK * 2**n samples, about len / 16 bytes in total. Samples
+    can be appended block by block (e.g. from stream_audio) and are readable
+    as soon as they are in; finish() adds the partial blocks at the end.
+    columns() reads the coarsest level that still resolves one pixel, so
+    drawing costs time proportional to the pixel width, not the song length.
+    """
+
+    def __init__(self, samples=None, scale=1.0):
+        '''
+        :param samples: optional buffer kept for zoom levels finer than PEAK_BLOCK
+        :param scale: divisor applied to the samples, e.g. 32768 for int16 PCM
+        '''
+        self.samples = samples
+        self.scale = scale
+        self.length = 0
+        self.levels = []  # [mins, maxs, count] per level, arrays grown by doubling
+        self._tail = np.zeros(0, dtype=np.float32)
+        self.finished = False
+
+    @classmethod
+    def from_audio(cls, samples, chunk_size=1 << 20):
+        '''
+        Index a whole buffer (float in [-1, 1] or int16 PCM; may be memory-mapped) chunk by chunk
+        '''
+        pyramid = cls(samples, 32768.0 if samples.dtype == np.int16 else 1.0)
+        for start in range(0, len(samples), chunk_size):
+            pyramid.append(samples[start:start + chunk_size])
+        pyramid.finish()
+        return pyramid
+
+    def append(self, block):
+        data = np.asarray(block, dtype=np.float32)
+        if self.scale != 1.0:
+            data = data / np.float32(self.scale)
+        self.length += len(data)
+        if len(self._tail):
+            # complete the partial block first instead of copying the whole block behind it
+            fill = min(PEAK_BLOCK - len(self._tail), len(data))
+            head = np.concatenate([self._tail, data[:fill]])
+            data = data[fill:]
+            if len(head) < PEAK_BLOCK:
+                self._tail = head
+                return
+            self._push(0, head.min(keepdims=True), head.max(keepdims=True))
+        whole = len(data) // PEAK_BLOCK * PEAK_BLOCK
+        self._tail = data[whole:].copy()
+        if whole:
+            blocks = data[:whole].reshape(-1, PEAK_BLOCK)
+            self._push(0, blocks.min(axis=1), blocks.max(axis=1))
+
+    def finish(self):
+        '''
+        Index the samples left in a partial block; nothing can be appended afterwards
+        '''
+        if len(self._tail):
+            self._push(0, self._tail.min(keepdims=True), self._tail.max(keepdims=True))
+            self._tail = self._tail[:0]
+        level = 0
+        while level < len(self.levels) and self.levels[level][2] > 1:
+            mins, maxs, count = self.levels[level]
+            paired = self.levels[level + 1][2] * 2 if level + 1 < len(self.levels) else 0
+            if paired < count:
+                # the entries not paired yet, an odd last one padded with itself
+                rest = np.arange(paired, paired + (count - paired + 1) // 2 * 2).clip(max=count - 1)
+                self._push(level + 1, mins[rest].reshape(-1, 2).min(axis=1), maxs[rest].reshape(-1, 2).max(axis=1),
+                           cascade=False)
+            level += 1
+        self.finished = True
+
+    def _push(self, level, mins, maxs, cascade=True):
+        if level == len(self.levels):
+            self.levels.append([np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.float32), 0])
+        entry = self.levels[level]
+        count = entry[2]
+        if count + len(mins) > len(entry[0]):
+            size = max(count + len(mins), 2 * len(entry[0]), 256)
+            for i in (0, 1):
+                grown = np.zeros(size, dtype=np.float32)
+                grown[:count] = entry[i][:count]
+                entry[i] = grown
+        entry[0][count:count + len(mins)] = mins
+        entry[1][count:count + len(maxs)] = maxs
+        entry[2] = count + len(mins)
+        if not cascade:
+            return
+        # pair up the entries that just became complete into the next level
+        paired = self.levels[level + 1][2] * 2 if level + 1 < len(self.levels) else 0
+        usable = entry[2] // 2 * 2
+        if usable - paired >= 2:
+            self._push(level + 1, entry[0][paired:usable].reshape(-1, 2).min(axis=1),
+                       entry[1][paired:usable].reshape(-1, 2).max(axis=1))
+
+    def columns(self, start, samples_per_pixel, width):
+        '''
+        Min and max of `width` pixel columns, column i covering samples from
+        start + i * samples_per_pixel; columns past the indexed audio are 0
+
+        :return: (mins, maxs) float32 arrays of length width
+        '''
+        mins = np.zeros(width, dtype=np.float32)
+        maxs = np.zeros(width, dtype=np.float32)
+        edges = (start + np.arange(width + 1) * samples_per_pixel).astype(np.int64)
+        if samples_per_pixel < PEAK_BLOCK and self.samples is not None:
+            source_min = source_max = None
+            block, level_length = 1, self.length
+        else:
+            level = 0
+            while level + 1 < len(self.levels) and PEAK_BLOCK << (level + 1) <= samples_per_pixel:
+                level += 1
+            if not self.levels:
+                return mins, maxs
+            source_min, source_max, level_length = self.levels[level]
+            block = PEAK_BLOCK << level
+        index = np.clip(edges // block, 0, level_length)
+        visible = np.nonzero((index[:-1] < level_length) & (np.maximum(edges[1:], edges[:-1] + 1) > 0))[0]
+        if not len(visible):
+            return mins, maxs
+        lo, hi = int(index[visible[0]]), int(max(index[visible[-1] + 1], index[visible[-1]] + 1))
+        if source_min is None:
+            window = np.asarray(self.samples[lo:hi], dtype=np.float32)
+            if self.scale != 1.0:
+                window = window / np.float32(self.scale)
+            window_min = window_max = window
+        else:
+            window_min, window_max = source_min[lo:hi], source_max[lo:hi]
+        # a column narrower than one entry still shows the entry it falls in
+        offsets = np.minimum(index[visible] - lo, hi - lo - 1)
+        mins[visible] = np.minimum.reduceat(window_min, offsets)
+        maxs[visible] = np.maximum.reduceat(window_max, offsets)
+        return mins, maxs